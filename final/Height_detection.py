@@ -1,197 +1,319 @@
+import argparse
+import json
+import sys
 import cv2
-import numpy as np
-import time
-
-# Initialize webcam
-cap = cv2.VideoCapture(1)
-if not cap.isOpened():
-    print("Error: Could not open camera")
-    exit()
+from config import load_config
+from detection import EDGE_PARAMS, scale_geometry, resolve_roi, measure_frame
+from sources import open_source
+from stabilizer import HeightStabilizer
+from pipeline import run_pipeline
+from metrics import Metrics, StageTimer, serve_metrics
+from overlay import composite_scale
+from calibration import config_undistorter
+from sinks import POLICIES, open_output, close_output
+from recorder import ClipRecorder
 
 # Define constants
-COLORS = {'RED': (0, 0, 255), 'GREEN': (0, 255, 0), 'BLUE': (255, 0, 0), 
+COLORS = {'RED': (0, 0, 255), 'GREEN': (0, 255, 0), 'BLUE': (255, 0, 0),
           'WHITE': (255, 255, 255), 'LIGHT_GRAY': (200, 200, 200), 'MAGENTA': (255, 0, 255)}
-EDGE_PARAMS = {'CANNY_THRESHOLDS': (30, 150), 'MIN_LINE_LENGTH': 100, 'MAX_LINE_GAP': 20, 'HOUGH_THRESHOLD': 30}
-STABILITY_PARAMS = {'HISTORY_LENGTH': 10, 'THRESHOLD': 0.2, 'DISPLAY_TIME': 3}
-
-# Variables for stabilizing height measurement
-stable_height, height_history, last_stable_time = None, [], 0
-scale_range = 15  # Default scale range
-
-def draw_scale(frame, scale_x, scale_y_bottom, scale_range):
-    """Draw measurement scale on the frame with given range"""
-    height, width = frame.shape[:2]
-    scale_y_top, scale_height = 20, scale_y_bottom - 20
-    
-    # Draw main scale line
-    cv2.line(frame, (scale_x, 0), (scale_x, height), COLORS['RED'], 2)
-    
-    # Set tick intervals based on scale range
-    major_tick = 5 if scale_range <= 25 else (10 if scale_range <= 50 else (20 if scale_range <= 100 else 50))
-    pixels_per_cm = scale_height / scale_range
-    
-    # Draw tick marks and labels
-    for i in range(scale_range + 1):
-        y_pos = int(scale_y_bottom - i * pixels_per_cm)
-        
-        if i % major_tick == 0:  # Major ticks
-            cv2.line(frame, (scale_x - 12, y_pos), (scale_x, y_pos), COLORS['RED'], 2)
-            cv2.putText(frame, f"{i} cm", (scale_x - 50, y_pos + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, COLORS['RED'], 2)
-        elif i % (major_tick // 5) == 0 and scale_range <= 50:  # Medium ticks
-            cv2.line(frame, (scale_x - 8, y_pos), (scale_x, y_pos), COLORS['RED'], 1)
-            cv2.putText(frame, f"{i}", (scale_x - 20, y_pos + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.3, COLORS['RED'], 1)
-        elif scale_range <= 25:  # Minor ticks
-            cv2.line(frame, (scale_x - 4, y_pos), (scale_x, y_pos), COLORS['RED'], 1)
-    
-    cv2.putText(frame, f"Scale (0-{scale_range}cm)", (scale_x - 100, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.6, COLORS['RED'], 2)
-    return pixels_per_cm
-
-def is_stable_measurement(history, new_value, threshold):
-    """Check if measurement is stable within threshold"""
-    if len(history) < STABILITY_PARAMS['HISTORY_LENGTH']:
-        return False
-    avg = sum(history) / len(history)
-    return all(abs(v - avg) < threshold for v in history) and abs(new_value - avg) < threshold
-
-# Create window with scale range trackbar
-cv2.namedWindow('Height Measurement (cm)')
-cv2.createTrackbar('Scale Range (cm)', 'Height Measurement (cm)', scale_range, 200, lambda x: None)
-
-while True:
-    # Capture and process frame
-    ret, frame = cap.read()
-    if not ret:
-        print("Failed to grab frame")
-        break
-    
-    height, width = frame.shape[:2]
-    scale_range = max(1, cv2.getTrackbarPos('Scale Range (cm)', 'Height Measurement (cm)'))
-    
-    # Process image for edge detection (simplified pipeline)
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    bilateral = cv2.bilateralFilter(gray, 9, 75, 75)
-    adaptive_thresh = cv2.adaptiveThreshold(bilateral, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-    edges = cv2.Canny(cv2.morphologyEx(adaptive_thresh, cv2.MORPH_OPEN, 
-                     cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1))), *EDGE_PARAMS['CANNY_THRESHOLDS'])
-    
-    # Setup scale and draw it
-    scale_x, scale_y_bottom = width - 70, height - 20
-    result = frame.copy()
-    pixels_per_cm = draw_scale(result, scale_x, scale_y_bottom, scale_range)
-    
-    # Detect lines and process measurements
-    found_new_measurement, current_height = False, None
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, EDGE_PARAMS['HOUGH_THRESHOLD'], 
-                           minLineLength=EDGE_PARAMS['MIN_LINE_LENGTH'], maxLineGap=EDGE_PARAMS['MAX_LINE_GAP'])
-    
-    if lines is not None:
-        # Find and sort horizontal lines
-        horizontal_lines = [(x1, y1, x2, y2, (y1+y2)//2) for line in lines for x1, y1, x2, y2 in [line[0]] 
-                           if x2 != x1 and abs((y2 - y1) / (x2 - x1)) < 0.1 
-                           and np.sqrt((x2 - x1)**2 + (y2 - y1)**2) > EDGE_PARAMS['MIN_LINE_LENGTH']]
-        
-        if len(horizontal_lines) >= 2:
-            horizontal_lines.sort(key=lambda line: line[4])
-            top_line, bottom_line = horizontal_lines[0], horizontal_lines[-1]
-            
-            # Calculate positions
-            top_x1, top_y1, top_x2, top_y2, top_y_avg = top_line
-            bot_x1, bot_y1, bot_x2, bot_y2, bot_y_avg = bottom_line
-            
-            # Draw lines
-            cv2.line(result, (top_x1, top_y_avg), (top_x2, top_y_avg), COLORS['GREEN'], 2)
-            cv2.line(result, (bot_x1, bot_y_avg), (bot_x2, bot_y_avg), COLORS['RED'], 2)
-            
-            # Calculate measurements
-            top_cm = (scale_y_bottom - top_y_avg) / pixels_per_cm
-            bot_cm = (scale_y_bottom - bot_y_avg) / pixels_per_cm
-            current_height = top_cm - bot_cm
-            
-            # Add measurement labels
-            cv2.putText(result, f"Top: {top_cm:.1f} cm", (top_x1 + 10, top_y_avg - 10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, COLORS['GREEN'], 2)
-            cv2.putText(result, f"Bottom: {bot_cm:.1f} cm", (bot_x1 + 10, bot_y_avg + 20), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, COLORS['RED'], 2)
-            
-            # Draw measurement line with arrows
-            mid_x = min(top_x1, bot_x1) - 20
-            cv2.line(result, (mid_x, top_y_avg), (mid_x, bot_y_avg), COLORS['MAGENTA'], 2)
-            
-            # Draw arrows and dotted lines
-            arrow_size = 5
-            for x_offset, y_offset in [(-arrow_size, arrow_size), (arrow_size, arrow_size)]:
-                cv2.line(result, (mid_x, top_y_avg), (mid_x + x_offset, top_y_avg + y_offset), COLORS['MAGENTA'], 2)
-                cv2.line(result, (mid_x, bot_y_avg), (mid_x + x_offset, bot_y_avg - y_offset), COLORS['MAGENTA'], 2)
-            
-            for x in range(top_x2, scale_x, 5):
-                cv2.line(result, (x, top_y_avg), (x + 3, top_y_avg), COLORS['GREEN'], 1)
-            for x in range(bot_x2, scale_x, 5):
-                cv2.line(result, (x, bot_y_avg), (x + 3, bot_y_avg), COLORS['RED'], 1)
-            
-            found_new_measurement = True
-    
-    # Handle stable height measurement
-    if found_new_measurement and current_height is not None:
-        height_history.append(current_height)
-        if len(height_history) > STABILITY_PARAMS['HISTORY_LENGTH']:
-            height_history.pop(0)
-        
-        # Check for stability
-        if time.time() - last_stable_time > STABILITY_PARAMS['DISPLAY_TIME'] and is_stable_measurement(
-                height_history, current_height, STABILITY_PARAMS['THRESHOLD']):
-            stable_height = sum(height_history) / len(height_history)
-            last_stable_time = time.time()
-            print(f"New stable height measurement: {stable_height:.1f} cm")
-    
-    # Display the measurements
+WINDOW = 'Height Measurement (cm)'
+
+def draw_measurement(result, measurement, scale_x):
+    """Draw the top/bottom lines, labels and measurement arrow"""
+    top_x1, top_x2, top_y_avg = (int(measurement['top_line'][f]) for f in ('x1', 'x2', 'y_avg'))
+    bot_x1, bot_x2, bot_y_avg = (int(measurement['bottom_line'][f]) for f in ('x1', 'x2', 'y_avg'))
+
+    # Draw lines
+    cv2.line(result, (top_x1, top_y_avg), (top_x2, top_y_avg), COLORS['GREEN'], 2)
+    cv2.line(result, (bot_x1, bot_y_avg), (bot_x2, bot_y_avg), COLORS['RED'], 2)
+
+    # Add measurement labels
+    cv2.putText(result, f"Top: {measurement['top_cm']:.1f} cm", (top_x1 + 10, top_y_avg - 10),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.6, COLORS['GREEN'], 2)
+    cv2.putText(result, f"Bottom: {measurement['bot_cm']:.1f} cm", (bot_x1 + 10, bot_y_avg + 20),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.6, COLORS['RED'], 2)
+
+    # Draw measurement line with arrows
+    mid_x = min(top_x1, bot_x1) - 20
+    cv2.line(result, (mid_x, top_y_avg), (mid_x, bot_y_avg), COLORS['MAGENTA'], 2)
+
+    # Draw arrows and dotted lines
+    arrow_size = 5
+    for x_offset, y_offset in [(-arrow_size, arrow_size), (arrow_size, arrow_size)]:
+        cv2.line(result, (mid_x, top_y_avg), (mid_x + x_offset, top_y_avg + y_offset), COLORS['MAGENTA'], 2)
+        cv2.line(result, (mid_x, bot_y_avg), (mid_x + x_offset, bot_y_avg - y_offset), COLORS['MAGENTA'], 2)
+
+    for x in range(top_x2, scale_x, 5):
+        cv2.line(result, (x, top_y_avg), (x + 3, top_y_avg), COLORS['GREEN'], 1)
+    for x in range(bot_x2, scale_x, 5):
+        cv2.line(result, (x, bot_y_avg), (x + 3, bot_y_avg), COLORS['RED'], 1)
+
+def draw_status(result, stable_height, current_height, history_length, history_target):
+    """Draw the final height box or the current measurement and stabilization progress"""
+    height, width = result.shape[:2]
     if stable_height is not None:
         # Draw a prominent box for the final measurement
         box_width, box_height = 300, 60
         box_x, box_y = (width - box_width) // 2, 30
-        
+
         # Draw semi-transparent background
         overlay = result.copy()
         cv2.rectangle(overlay, (box_x, box_y), (box_x + box_width, box_y + box_height), (0, 0, 0), -1)
         cv2.addWeighted(overlay, 0.7, result, 0.3, 0, result)
-        
+
         # Add the measurement text
         final_text = f"FINAL HEIGHT: {stable_height:.1f} cm"
         text_size = cv2.getTextSize(final_text, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2)[0]
         text_x = box_x + (box_width - text_size[0]) // 2
         text_y = box_y + (box_height + text_size[1]) // 2
         cv2.putText(result, final_text, (text_x, text_y), cv2.FONT_HERSHEY_SIMPLEX, 1.0, COLORS['WHITE'], 2)
-        
+
         # If currently measuring, also display the real-time measurement
-        if found_new_measurement and current_height is not None:
-            cv2.putText(result, f"Current: {current_height:.1f} cm", 
+        if current_height is not None:
+            cv2.putText(result, f"Current: {current_height:.1f} cm",
                         (width//2 - 100, height//2), cv2.FONT_HERSHEY_SIMPLEX, 1.0, COLORS['MAGENTA'], 2)
-    elif found_new_measurement and current_height is not None:
+    elif current_height is not None:
         # If no stable height yet, show current measurement
-        cv2.putText(result, f"HEIGHT: {current_height:.1f} cm", 
+        cv2.putText(result, f"HEIGHT: {current_height:.1f} cm",
                     (width//2 - 100, height//2), cv2.FONT_HERSHEY_SIMPLEX, 1.0, COLORS['MAGENTA'], 2)
-        cv2.putText(result, f"Stabilizing: {len(height_history)}/{STABILITY_PARAMS['HISTORY_LENGTH']} frames", 
+        cv2.putText(result, f"Stabilizing: {history_length}/{history_target} frames",
                     (width//2 - 120, height//2 + 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, COLORS['WHITE'], 1)
-    
-    # Display results
-    cv2.imshow("Edge Detection", cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR))
-    cv2.putText(result, f"Scale: {scale_range}cm | r:reset | c:clear stable | +/-:adjust | q:quit", 
-                (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, COLORS['WHITE'], 1)
-    cv2.imshow("Height Measurement (cm)", result)
-    
-    # Handle keyboard input with simplified control structure
-    key = cv2.waitKey(1) & 0xFF
-    if key == ord('q'):
-        break
-    elif key in [ord('+'), ord('=')]:
-        cv2.setTrackbarPos('Scale Range (cm)', 'Height Measurement (cm)', min(200, scale_range + 1))
-    elif key in [ord('-'), ord('_')]:
-        cv2.setTrackbarPos('Scale Range (cm)', 'Height Measurement (cm)', max(5, scale_range - 1))
-    elif key == ord('r'):
-        cv2.setTrackbarPos('Scale Range (cm)', 'Height Measurement (cm)', 15)
-    elif key == ord('c'):
-        stable_height, height_history, last_stable_time = None, [], 0
-        print("Cleared stable height measurement")
-
-# Clean up
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+
+def write_record(out, record):
+    """Write one JSON line to the measurement output, or queue the record for the sinks"""
+    if hasattr(out, 'publish'):
+        out.publish(record)
+        return
+    out.write(json.dumps(record) + "\n")
+    out.flush()
+
+def frame_record(frame_seq, frame_time, measurement):
+    """Build the per-frame JSON record of a measurement (or a miss)"""
+    record = {'type': 'frame', 'seq': frame_seq, 'timestamp': frame_time, 'height': None}
+    if measurement is not None:
+        record.update(height=measurement['height'], top_y=measurement['top_y'],
+                      bot_y=measurement['bot_y'], line_count=measurement['line_count'])
+    return record
+
+def run(source, config, out=None, roi_provider=None):
+    """Measure heights from an opened frame source, with the GUI or headless, writing JSON lines to out when given.
+
+    roi_provider(frame, seq), when given, replaces config['rois'] per frame: it returns the regions to
+    measure, [] for the whole frame or None to skip measuring that frame. A provider with a measured(height)
+    method is told every height measured in its regions.
+    """
+    headless = config['headless']
+    edge_params = dict(EDGE_PARAMS, **config['edge_params'])
+    scale_range = max(1, int(config['scale_range']))
+
+    # Stabilizing height measurement
+    stabilizer = HeightStabilizer(config['stability_params'])
+
+    # Optional instrumentation served on http://127.0.0.1:<metrics_port>/metrics, no timing calls at all when off
+    metrics = timer = None
+    if config['metrics_port']:
+        metrics = Metrics()
+        serve_metrics(metrics, config['metrics_port'])
+        timer = StageTimer(metrics)
+
+    # Raw frames around stable heights (or out-of-tolerance measurements) are written as clips in the background
+    recorder = ClipRecorder(config['clips'], config['clip_params']) if config['clips'] else None
+
+    # Undistortion maps, built once per frame size
+    undistorter, undistort_size, undistort_rois = None, None, None
+
+    # Create window with scale range trackbar
+    if not headless:
+        cv2.namedWindow(WINDOW)
+        cv2.createTrackbar('Scale Range (cm)', WINDOW, scale_range, 200, lambda x: None)
+
+    try:
+        while True:
+            try:
+                # Take the next frame (the newest one for live cameras)
+                if timer: timer.begin()
+                ret, frame, frame_seq, frame_time = source.read()
+                if timer: timer.lap('capture')
+                if not ret:
+                    print("Failed to grab frame" if source.live else "End of recording", file=sys.stderr)
+                    break
+
+                raw_frame = frame
+                height, width = frame.shape[:2]
+                if config['calibration'] and (width, height) != undistort_size:
+                    undistort_size, undistorter = (width, height), config_undistorter(config, width, height)
+                    if config['undistort_rois_only'] and config['rois']:
+                        undistort_rois = [resolve_roi(roi, width, height) for roi in config['rois']]
+                if undistorter is not None:
+                    frame = undistorter.apply(frame, undistort_rois)
+                    if timer: timer.lap('undistort')
+                if not headless:
+                    scale_range = max(1, cv2.getTrackbarPos('Scale Range (cm)', WINDOW))
+
+                # Regions to measure: the configured ROIs, or whatever the provider (e.g. a detector) finds in this frame
+                rois = config['rois']
+                if roi_provider is not None:
+                    rois = roi_provider(frame, frame_seq)
+                    if timer: timer.lap('roi_provider')
+
+                # Detect edges and lines and measure the top/bottom distance
+                edges, measurement = None, None
+                if rois is not None:
+                    edges, measurement = measure_frame(frame, scale_range, edge_params, rois, timer)
+                current_height = measurement['height'] if measurement is not None else None
+                if current_height is not None and hasattr(roi_provider, 'measured'):
+                    roi_provider.measured(current_height)
+                if metrics:
+                    metrics.inc('frames_processed')
+                    metrics.inc('frames_without_rois', int(rois is None))
+                    metrics.inc('frames_without_lines', int(rois is not None and measurement is None))
+                    metrics.set('capture_frames_dropped', source.frames_dropped)
+                if out is not None:
+                    write_record(out, frame_record(frame_seq, frame_time, measurement))
+                    if timer: timer.lap('output')
+
+                # Handle stable height measurement
+                announced = None
+                if current_height is not None:
+                    stable_height = stabilizer.update(current_height, frame_time)
+                    if stable_height is not None:
+                        announced = stable_height
+                        if metrics: metrics.inc('stable_events')
+                        if out is not None:
+                            write_record(out, {'type': 'stable', 'seq': frame_seq, 'timestamp': frame_time, 'height': stable_height})
+                        if not headless:
+                            print(f"New stable height measurement: {stable_height:.1f} cm")
+
+                if timer: timer.lap('stabilize')
+                if recorder is not None:
+                    recorder.add(raw_frame, frame_record(frame_seq, frame_time, measurement), announced)
+                    if timer: timer.lap('record')
+                if headless:
+                    continue
+
+                # Setup scale and draw it
+                # The scale is rendered once per (range, size) and copied in with one masked copy
+                scale_x, scale_y_bottom, _ = scale_geometry(width, height, scale_range)
+                result = frame.copy()
+                composite_scale(result, scale_range)
+                for roi in rois or []:
+                    x0, y0, x1, y1 = resolve_roi(roi, width, height)
+                    cv2.rectangle(result, (x0, y0), (x1, y1), COLORS['LIGHT_GRAY'], 1)
+                if measurement is not None:
+                    draw_measurement(result, measurement, scale_x)
+                draw_status(result, stabilizer.stable_height, current_height, stabilizer.window.count,
+                            stabilizer.params['HISTORY_LENGTH'])
+                if timer: timer.lap('draw')
+
+                # Display results
+                if edges is not None:
+                    cv2.imshow("Edge Detection", cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR))
+                cv2.putText(result, f"Scale: {scale_range}cm | r:reset | c:clear stable | +/-:adjust | q:quit",
+                            (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, COLORS['WHITE'], 1)
+                cv2.imshow(WINDOW, result)
+
+                # Handle keyboard input with simplified control structure
+                key = cv2.waitKey(1) & 0xFF
+                if timer: timer.lap('display')
+                if key == ord('q'):
+                    break
+                elif key in [ord('+'), ord('=')]:
+                    cv2.setTrackbarPos('Scale Range (cm)', WINDOW, min(200, scale_range + 1))
+                elif key in [ord('-'), ord('_')]:
+                    cv2.setTrackbarPos('Scale Range (cm)', WINDOW, max(5, scale_range - 1))
+                elif key == ord('r'):
+                    cv2.setTrackbarPos('Scale Range (cm)', WINDOW, 15)
+                elif key == ord('c'):
+                    stabilizer.reset()
+                    print("Cleared stable height measurement")
+            finally:
+                # Commit here so the last frame and frames left by break/continue are counted too
+                if timer: timer.end()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if recorder is not None:
+            recorder.close()
+        print(f"Captured {source.frames_captured} frames, dropped {source.frames_dropped} stale frames", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure object height from a camera')
+    parser.add_argument('--config', type=str, help='Path to a JSON config file')
+    parser.add_argument('--source', type=str, help='Camera index, video file, image directory or image glob')
+    parser.add_argument('--realtime', action='store_true', help='Pace recorded sources at their frame rate instead of max speed')
+    parser.add_argument('--headless', action='store_true', help='No GUI, write JSON lines measurements instead')
+    parser.add_argument('--output', type=str, help="Headless output file, '-' for stdout")
+    parser.add_argument('--sink', type=str, action='append',
+                        help='Also send measurements to a file, udp://host:port, tcp://host:port, unix:///path or redis://host:port/channel (repeatable)')
+    parser.add_argument('--sink-policy', type=str, choices=POLICIES, help='What a sink that falls behind does (default drop_oldest)')
+    parser.add_argument('--clips', type=str, help='Write clips of the raw frames around every stable height to this directory')
+    parser.add_argument('--clip-tolerance', type=str, help='LOW,HIGH in cm: also record a clip when a measurement leaves this range')
+    parser.add_argument('--workers', type=int, help='Headless only: measure in this many worker processes (0 = single process)')
+    parser.add_argument('--metrics-port', type=int, help='Serve per-stage timings and counters on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--roi', type=str, action='append',
+                        help='Region to process as x0,y0,x1,y1 in pixels, or in frame fractions when all four are <= 1 (repeatable)')
+    parser.add_argument('--scale-range', type=int, help='Scale range in cm (replaces the trackbar in headless mode)')
+    parser.add_argument('--calibration', type=str, help='Calibration JSON file, frames are undistorted with its maps')
+    parser.add_argument('--camera-name', type=str, help='Calibration key of the camera (default: the source)')
+    parser.add_argument('--undistort-rois-only', action='store_true', help='Undistort only inside the --roi regions')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    for key, value in [('source', args.source), ('output', args.output), ('workers', args.workers),
+                       ('metrics_port', args.metrics_port), ('scale_range', args.scale_range),
+                       ('calibration', args.calibration), ('camera_name', args.camera_name)]:
+        if value is not None:
+            config[key] = value
+    if args.clips:
+        config['clips'] = args.clips
+    if args.clip_tolerance:
+        config['clip_params']['TOLERANCE'] = [float(v) for v in args.clip_tolerance.split(',')]
+    if args.sink:
+        config['sinks'] = config['sinks'] + args.sink
+    if args.sink_policy:
+        config['sink_params']['POLICY'] = args.sink_policy
+    if args.roi:
+        config['rois'] = [[float(v) if '.' in v else int(v) for v in roi.split(',')] for roi in args.roi]
+        for roi in config['rois']:
+            if len(roi) != 4:
+                parser.error(f"--roi needs x0,y0,x1,y1, got {','.join(map(str, roi))}")
+    config['headless'] = config['headless'] or args.headless
+    config['realtime'] = config['realtime'] or args.realtime
+    config['undistort_rois_only'] = config['undistort_rois_only'] or args.undistort_rois_only
+
+    if config['workers'] > 0:
+        if not config['headless']:
+            print("Error: --workers needs --headless")
+            exit()
+        # Metrics and clips live in the single-process frame loop, the workers only send measurements back
+        if config['metrics_port'] or config['clips']:
+            parser.error("--metrics-port and --clips need the single-process loop, leave out --workers")
+        # Capture, measuring workers and the in-order collector run as separate processes
+        out = open_output(config)
+        try:
+            run_pipeline(config, config['workers'],
+                         lambda seq, timestamp, measurement: write_record(out, frame_record(seq, timestamp, measurement)),
+                         lambda seq, timestamp, height: write_record(out, {'type': 'stable', 'seq': seq,
+                                                                           'timestamp': timestamp, 'height': height}))
+        finally:
+            close_output(out)
+        return
+
+    # Initialize webcam or recording
+    source = open_source(config['source'], realtime=config['realtime'])
+    if not source.isOpened():
+        print(f"Error: Could not open source {config['source']}")
+        exit()
+
+    out = open_output(config, config['headless'])
+    try:
+        run(source, config, out)
+    finally:
+        # Clean up
+        close_output(out)
+        source.release()
+        if not config['headless']:
+            cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import load_config
+from detection import EDGE_PARAMS, PREPROCESS_CHAINS, scale_geometry, resolve_roi, measure_frame
+from Height_detection import COLORS, draw_measurement, draw_status
+from metrics import StageTimer
+from overlay import composite_scale, render_scale
+from sources import open_source
+
+RESOLUTIONS = {'480p': (640, 480), '720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+
+def load_frames(spec, max_frames):
+    """Read a recording into memory so decoding is not part of the timings"""
+    source = open_source(spec)
+    if not source.isOpened():
+        print(f"Error: Could not open source {spec}")
+        exit()
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame, _, _ = source.read()
+        if not ret:
+            break
+        frames.append(frame.copy())
+    source.release()
+    return frames
+
+def synthetic_frames(width, height, count, seed=0):
+    """Noisy frames with a bright train-like band whose top and bottom edges move a little"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(count):
+        frame = np.full((height, width, 3), 60, np.uint8)
+        top = int(height * rng.uniform(0.25, 0.35))
+        bottom = int(height * rng.uniform(0.65, 0.75))
+        frame[top:bottom, width // 6:width * 5 // 6] = 200
+        frames.append(cv2.add(frame, rng.integers(0, 16, frame.shape, dtype=np.uint8)))
+    return frames
+
+def time_ms(fn, *args):
+    """Call fn and return (result, elapsed milliseconds)"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+def print_table(rows, columns):
+    """Print result dicts as an aligned text table"""
+    widths = [max(len(col), *(len(f"{row[col]:.3f}" if isinstance(row[col], float) else str(row[col])) for row in rows))
+              for col in columns]
+    print("  ".join(col.ljust(w) for col, w in zip(columns, widths)))
+    for row in rows:
+        cells = [f"{row[col]:.3f}" if isinstance(row[col], float) else str(row[col]) for col in columns]
+        print("  ".join(cell.ljust(w) for cell, w in zip(cells, widths)))
+
+def run_variant(frames, scale_range, params, rois):
+    """Measure every frame with params and return (per-frame ms, measurements)"""
+    measured = [time_ms(measure_frame, frame, scale_range, params, rois) for frame in frames]
+    return [ms for _, ms in measured], [measurement for (_, measurement), _ in measured]
+
+def compare_to_baseline(name, frame_ms, measurements, baseline, tolerance):
+    """Summarize a variant's cost and its height difference from the baseline measurements"""
+    heights = [m['height'] if m is not None else None for m in measurements]
+    diffs = [abs(h - b['height']) for h, b in zip(heights, baseline) if h is not None and b is not None]
+    row = {'variant': name, 'frame_ms': float(np.mean(frame_ms)), 'fps': 1000 / float(np.mean(frame_ms)),
+           'detected': f"{sum(h is not None for h in heights)}/{len(heights)}",
+           'mean_diff': float(np.mean(diffs)) if diffs else float('nan'),
+           'max_diff': float(np.max(diffs)) if diffs else float('nan')}
+    row['ok'] = bool(diffs) and row['max_diff'] <= tolerance
+    return row
+
+def bench_preprocess(frames, scale_range, edge_params, rois, chains, tolerance):
+    """Time each preprocessing chain and compare its heights with the bilateral baseline"""
+    grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+    rows, baseline = [], None
+    for name in ['bilateral'] + [c for c in chains if c != 'bilateral']:
+        filter_ms = [time_ms(PREPROCESS_CHAINS[name], gray)[1] for gray in grays]
+        frame_ms, measurements = run_variant(frames, scale_range, dict(edge_params, PREPROCESS=name), rois)
+        baseline = baseline or measurements
+        rows.append(dict(compare_to_baseline(name, frame_ms, measurements, baseline, tolerance),
+                         filter_ms=float(np.mean(filter_ms))))
+    return sorted(rows, key=lambda row: row['frame_ms'])
+
+def bench_engines(frames, scale_range, edge_params, rois, strips, tolerance):
+    """Compare the row-projection engine (with several strip counts) against the Hough engine"""
+    variants = [('hough', dict(edge_params, ENGINE='hough'))]
+    variants += [(f"projection/{n}", dict(edge_params, ENGINE='projection', PROJECTION_STRIPS=n)) for n in strips]
+    rows, baseline = [], None
+    for name, params in variants:
+        frame_ms, measurements = run_variant(frames, scale_range, params, rois)
+        baseline = baseline or measurements
+        found = [m for m in measurements if m is not None]
+        rows.append(dict(compare_to_baseline(name, frame_ms, measurements, baseline, tolerance),
+                         p95_ms=float(np.percentile(frame_ms, 95)),
+                         top_y=float(np.mean([m['top_y'] for m in found])) if found else float('nan'),
+                         bot_y=float(np.mean([m['bot_y'] for m in found])) if found else float('nan')))
+    return rows
+
+def summarize(samples):
+    """Mean and percentile latencies (ms) of a list of samples"""
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'mean_ms': float(np.mean(samples)), 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+def time_stages(frame, params, scale_range, rois=None):
+    """Run the pipeline of Height_detection.py once with the given params and ROIs, timing every stage separately"""
+    height, width = frame.shape[:2]
+    timer = StageTimer(None)
+    _, measurement = measure_frame(frame, scale_range, params, rois, timer)
+    timings = {name: seconds * 1000 for name, seconds in timer.frame.items()}
+
+    # The scale is rendered once per (range, size) and then only composited, time both apart
+    scale_x = scale_geometry(width, height, scale_range)[0]
+    result = frame.copy()
+    _, cold_ms = time_ms(render_scale.__wrapped__, scale_range, width, height)
+    render_scale(scale_range, width, height, 'cm')
+    _, timings['scale_composite'] = time_ms(composite_scale, result, scale_range)
+
+    def composite():
+        for roi in rois or []:
+            x0, y0, x1, y1 = resolve_roi(roi, width, height)
+            cv2.rectangle(result, (x0, y0), (x1, y1), COLORS['LIGHT_GRAY'], 1)
+        if measurement is not None:
+            draw_measurement(result, measurement, scale_x)
+        draw_status(result, 12.3, measurement['height'] if measurement else None, 10, 10)
+    _, timings['overlay'] = time_ms(composite)
+    timings['total'] = sum(timings.values())
+    # Paid once per scale range and frame size, so kept out of the per-frame total
+    timings['scale_render (cold)'] = cold_ms
+    return timings
+
+def bench_stages(frame_sets, params, scale_range, rois, repeats):
+    """Time every stage on every frame of each (label, frames) set and return summary rows"""
+    rows = []
+    for label, frames in frame_sets:
+        samples = {}
+        for _ in range(repeats):
+            for frame in frames:
+                for name, ms in time_stages(frame, params, scale_range, rois).items():
+                    samples.setdefault(name, []).append(ms)
+        for name, values in samples.items():
+            row = dict({'frames': label, 'stage': name}, **summarize(values))
+            row['fps'] = 1000 / row['mean_ms'] if row['mean_ms'] > 0 else float('inf')
+            rows.append(row)
+    return rows
+
+def compare_runs(rows, previous_path):
+    """Print the mean latency change against an earlier JSON result file"""
+    with open(previous_path) as f:
+        previous = {(row['frames'], row['stage']): row for row in json.load(f)['results']}
+    changes = []
+    for row in rows:
+        old = previous.get((row['frames'], row['stage']))
+        if old is not None:
+            changes.append({'frames': row['frames'], 'stage': row['stage'], 'old_ms': old['mean_ms'],
+                            'new_ms': row['mean_ms'], 'ratio': row['mean_ms'] / max(old['mean_ms'], 1e-9)})
+    print(f"Compared with {previous_path}")
+    print_table(changes, ['frames', 'stage', 'old_ms', 'new_ms', 'ratio'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the height measurement pipeline')
+    parser.add_argument('--config', type=str, help='Path to a JSON config file')
+    parser.add_argument('--json', type=str, help='Also write the results to this JSON file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = commands.add_parser('preprocess', help='Compare preprocessing chains against the bilateral baseline')
+    preprocess.add_argument('--source', type=str, required=True, help='Reference clip: video file, image directory or glob')
+    preprocess.add_argument('--max-frames', type=int, default=300, help='Number of frames to load from the clip')
+    preprocess.add_argument('--chains', type=str, default=','.join(PREPROCESS_CHAINS), help='Comma separated chain names')
+    preprocess.add_argument('--tolerance', type=float, default=0.2, help='Allowed height difference from the baseline (cm)')
+
+    engines = commands.add_parser('engines', help='Compare the row-projection engine with the Hough engine')
+    engines.add_argument('--source', type=str, required=True, help='Reference clip: video file, image directory or glob')
+    engines.add_argument('--max-frames', type=int, default=300, help='Number of frames to load from the clip')
+    engines.add_argument('--strips', type=str, default='1,4,8', help='Comma separated strip counts for the projection engine')
+    engines.add_argument('--tolerance', type=float, default=0.2, help='Allowed height difference from Hough (cm)')
+
+    stages = commands.add_parser('stages', help='Per-stage latency of the pipeline at several resolutions')
+    stages.add_argument('--source', type=str, help='Recorded frames to use as well as the synthetic ones')
+    stages.add_argument('--resolutions', type=str, default=','.join(RESOLUTIONS), help='Comma separated from ' + ', '.join(RESOLUTIONS))
+    stages.add_argument('--frames', type=int, default=20, help='Frames per resolution')
+    stages.add_argument('--repeats', type=int, default=3, help='Passes over the frames')
+    stages.add_argument('--compare', type=str, help='Earlier JSON result file to compare against')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    edge_params = dict(EDGE_PARAMS, **config['edge_params'])
+    scale_range = max(1, int(config['scale_range']))
+
+    if args.command == 'preprocess':
+        frames = load_frames(args.source, args.max_frames)
+        rows = bench_preprocess(frames, scale_range, edge_params, config['rois'], args.chains.split(','), args.tolerance)
+        print(f"{len(frames)} frames from {args.source}, tolerance {args.tolerance} cm")
+        print_table(rows, ['variant', 'filter_ms', 'frame_ms', 'fps', 'detected', 'mean_diff', 'max_diff', 'ok'])
+        passing = [row['variant'] for row in rows if row['ok']]
+        print(f"Cheapest chain within tolerance: {passing[0] if passing else 'none'}")
+    elif args.command == 'engines':
+        frames = load_frames(args.source, args.max_frames)
+        strips = [int(n) for n in args.strips.split(',')]
+        rows = bench_engines(frames, scale_range, edge_params, config['rois'], strips, args.tolerance)
+        print(f"{len(frames)} frames from {args.source}, heights compared with the Hough engine")
+        print_table(rows, ['variant', 'frame_ms', 'p95_ms', 'fps', 'detected', 'top_y', 'bot_y', 'mean_diff', 'max_diff'])
+    elif args.command == 'stages':
+        recorded = load_frames(args.source, args.frames) if args.source else []
+        frame_sets = []
+        for name in args.resolutions.split(','):
+            width, height = RESOLUTIONS[name]
+            frame_sets.append((f"synthetic-{name}", synthetic_frames(width, height, args.frames)))
+            if recorded:
+                frame_sets.append((f"recorded-{name}", [cv2.resize(frame, (width, height)) for frame in recorded]))
+        rows = bench_stages(frame_sets, edge_params, scale_range, config['rois'], args.repeats)
+        print_table(rows, ['frames', 'stage', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'fps'])
+        if args.compare:
+            compare_runs(rows, args.compare)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'command': args.command, 'argv': sys.argv[1:], 'time': time.time(),
+                       'opencv': cv2.__version__, 'numpy': np.__version__, 'python': platform.python_version(),
+                       'machine': platform.machine(), 'cpus': os.cpu_count(), 'cv2_threads': cv2.getNumThreads(),
+                       'results': rows}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import collections
+import functools
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# Calibrations live in one JSON file, one entry per camera and resolution
+DEFAULT_CALIBRATION_FILE = 'calibration.json'
+
+# Checkerboard images are searched at most this wide, corners are then refined at full resolution
+DETECT_MAX_WIDTH = 1280
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+def calibration_key(camera, width, height):
+    """Key of a calibration entry, e.g. 'cam1@1280x720'"""
+    return f"{camera}@{int(width)}x{int(height)}"
+
+def read_calibrations(path):
+    """Return all entries of a calibration file, {} if it does not exist yet"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_calibration(path, camera, size, camera_matrix, dist_coeffs, **extra):
+    """Store camera_matrix and dist_coeffs for (camera, (width, height)), keeping the other entries"""
+    calibrations = read_calibrations(path)
+    calibrations[calibration_key(camera, *size)] = dict(
+        camera_matrix=np.asarray(camera_matrix, np.float64).tolist(),
+        dist_coeffs=np.asarray(dist_coeffs, np.float64).ravel().tolist(),
+        saved=time.strftime('%Y-%m-%dT%H:%M:%S'), **extra)
+
+    # Write next to the target and rename, so a crash never leaves a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(calibrations, f, indent=2)
+    os.replace(tmp_path, path)
+
+def load_calibration(path, camera, size):
+    """Return (camera_matrix, dist_coeffs) for (camera, (width, height)), (None, None) if there is no entry"""
+    entry = read_calibrations(path).get(calibration_key(camera, *size))
+    if entry is None:
+        return None, None
+    return np.array(entry['camera_matrix'], np.float64), np.array(entry['dist_coeffs'], np.float64)
+
+class Undistorter:
+    """Undistortion maps built once with initUndistortRectifyMap and applied with remap.
+
+    fixed_point stores the maps as CV_16SC2 plus an interpolation table, which halves
+    their size and makes remap faster at the cost of 1/32 pixel resolution.
+    """
+
+    def __init__(self, camera_matrix, dist_coeffs, size, fixed_point=True):
+        self.size = tuple(size)
+        map_type = cv2.CV_16SC2 if fixed_point else cv2.CV_32FC1
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(camera_matrix, dist_coeffs, None, camera_matrix,
+                                                           self.size, map_type)
+
+    def apply(self, frame, rois=None):
+        """Undistort the whole frame, or only the given pixel (x0, y0, x1, y1) ROIs of a copy of it"""
+        if not rois:
+            return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR)
+        result = frame.copy()
+        for x0, y0, x1, y1 in rois:
+            result[y0:y1, x0:x1] = cv2.remap(frame, self.map1[y0:y1, x0:x1], self.map2[y0:y1, x0:x1],
+                                             cv2.INTER_LINEAR)
+        return result
+
+@functools.lru_cache(maxsize=8)
+def _cached_undistorter(matrix_bytes, dist_bytes, size, fixed_point):
+    camera_matrix = np.frombuffer(matrix_bytes, np.float64).reshape(3, 3)
+    return Undistorter(camera_matrix, np.frombuffer(dist_bytes, np.float64), size, fixed_point)
+
+def get_undistorter(camera_matrix, dist_coeffs, size, fixed_point=True):
+    """Return a cached Undistorter, so the maps for the same parameters and size are built only once"""
+    return _cached_undistorter(np.asarray(camera_matrix, np.float64).tobytes(),
+                               np.asarray(dist_coeffs, np.float64).ravel().tobytes(), tuple(size), fixed_point)
+
+def config_undistorter(config, width, height):
+    """Return the Undistorter for the configured calibration file, camera and frame size, None when off or missing"""
+    if not config.get('calibration'):
+        return None
+    camera = config.get('camera_name') or config['source']
+    camera_matrix, dist_coeffs = load_calibration(config['calibration'], camera, (width, height))
+    if camera_matrix is None:
+        print(f"Warning: no calibration for {calibration_key(camera, width, height)} in {config['calibration']}, "
+              f"frames are not undistorted", file=sys.stderr)
+        return None
+    return get_undistorter(camera_matrix, dist_coeffs, (width, height), config.get('undistort_fixed_point', True))
+
+def list_images(path):
+    """Image files of a directory (sorted), or [path] for a single file"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(p for p in glob.glob(os.path.join(path, '*')) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+def board_points(checker_size, square_size):
+    """3-D board coordinates of the inner corners: (0,0,0), (1,0,0), (2,0,0) ... times square_size"""
+    objp = np.zeros((checker_size[0] * checker_size[1], 3), np.float32)
+    objp[:, :2] = np.mgrid[0:checker_size[0], 0:checker_size[1]].T.reshape(-1, 2) * square_size
+    return objp
+
+def find_corners(path, checker_size):
+    """Return (corners or None, (width, height)) of the checkerboard in one image file"""
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None, None
+    height, width = gray.shape
+    checker_size = tuple(checker_size)
+
+    # Search a downscaled copy of large images, fall back to full resolution if that misses
+    found, corners = False, None
+    factor = width / DETECT_MAX_WIDTH
+    if factor > 1:
+        small = cv2.resize(gray, (DETECT_MAX_WIDTH, int(round(height / factor))), interpolation=cv2.INTER_AREA)
+        found, corners = cv2.findChessboardCorners(small, checker_size, None)
+        if found:
+            corners = corners * np.float32(factor)
+    if not found:
+        found, corners = cv2.findChessboardCorners(gray, checker_size, None)
+    if not found:
+        return None, (width, height)
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), SUBPIX_CRITERIA), (width, height)
+
+def _find_corners_task(task):
+    path, checker_size = task
+    return find_corners(path, checker_size)
+
+def _init_corner_worker():
+    # One OpenCV thread per process, the parallelism comes from the pool
+    cv2.setNumThreads(1)
+
+def file_digest(path):
+    """SHA-1 of a file's content"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def detect_corners(paths, checker_size, cache_dir=None, processes=None):
+    """Find checkerboard corners in many images with a process pool, reusing cached results.
+
+    Results are cached in cache_dir as <content sha1>-<cols>x<rows>.npz (misses included),
+    so renamed or re-added images are never searched again. Returns {path: (corners or None, size)}.
+    """
+    results, todo = {}, []
+    for path in paths:
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, f"{file_digest(path)}-{checker_size[0]}x{checker_size[1]}.npz")
+            if os.path.exists(cache_path):
+                with np.load(cache_path) as cached:
+                    results[path] = (cached['corners'] if cached['found'] else None, tuple(cached['size']))
+                continue
+        todo.append((path, cache_path))
+
+    if len(todo) > 1 and processes != 1:
+        with mp.get_context('spawn').Pool(processes, initializer=_init_corner_worker) as pool:
+            found = pool.map(_find_corners_task, [(path, tuple(checker_size)) for path, _ in todo], chunksize=1)
+    else:
+        found = [find_corners(path, checker_size) for path, _ in todo]
+
+    for (path, cache_path), (corners, size) in zip(todo, found):
+        results[path] = (corners, size)
+        if cache_path and size is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_path, found=corners is not None, size=np.array(size),
+                     corners=corners if corners is not None else np.empty((0, 1, 2), np.float32))
+    return results
+
+def calibrate_images(path, checker_size=(9, 6), square_size=2.5, cache_dir=None, processes=None):
+    """Calibrate from one checkerboard image or a directory of them.
+
+    Returns None when no board was found, otherwise a dict with camera_matrix, dist_coeffs, size,
+    rms, views [(path, reprojection error in px)] and skipped [(path, reason)].
+    """
+    paths = list_images(path)
+    if cache_dir is None:
+        cache_dir = os.path.join(path if os.path.isdir(path) else os.path.dirname(path) or '.', '.corner_cache')
+    detections = detect_corners(paths, checker_size, cache_dir, processes)
+
+    # All views must share one resolution, the most common one wins
+    sizes = collections.Counter(size for corners, size in detections.values() if corners is not None)
+    if not sizes:
+        return None
+    size = sizes.most_common(1)[0][0]
+    views, skipped = [], []
+    for image_path in paths:
+        corners, image_size = detections[image_path]
+        if corners is None:
+            skipped.append((image_path, 'no checkerboard found' if image_size else 'unreadable'))
+        elif image_size != size:
+            skipped.append((image_path, f"size {image_size[0]}x{image_size[1]} differs from {size[0]}x{size[1]}"))
+        else:
+            views.append((image_path, corners))
+
+    objp = board_points(checker_size, square_size)
+    image_points = [corners for _, corners in views]
+    rms, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera([objp] * len(views), image_points, size,
+                                                                         None, None)
+
+    # RMS distance between detected and reprojected corners of each view
+    errors = []
+    for corners, rvec, tvec in zip(image_points, rvecs, tvecs):
+        projected, _ = cv2.projectPoints(objp, rvec, tvec, camera_matrix, dist_coeffs)
+        errors.append(float(np.sqrt(np.mean(np.sum((projected - corners) ** 2, axis=-1)))))
+    return {'camera_matrix': camera_matrix, 'dist_coeffs': dist_coeffs, 'size': size, 'rms': rms,
+            'views': [(image_path, error) for (image_path, _), error in zip(views, errors)], 'skipped': skipped}
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import numpy as np
+
+
+class LatestFrameCapture:
+    """Read frames on a background thread and keep only the newest one (latest frame wins)"""
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.frames_captured, self.frames_dropped = 0, 0
+        self.running, self.failed = False, False
+
+        # Capture writes into the back buffer, the slot holds the newest complete frame
+        self._back, self._slot, self._out = None, None, None
+        self._seq, self._timestamp, self._consumed_seq = 0, 0.0, 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="LatestFrameCapture", daemon=True)
+
+    def start(self):
+        """Start the capture thread and return self"""
+        self.running = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the capture thread (does not release the capture device)"""
+        self.running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout=2.0)
+
+    def _run(self):
+        while self.running:
+            ret, frame = self.cap.read(self._back)
+            timestamp = time.time()
+            if not ret or frame is None:
+                with self._cond:
+                    self.failed = True
+                    self._cond.notify_all()
+                break
+
+            with self._cond:
+                # The previous slot was never handed out, so it is dropped
+                if self._seq > self._consumed_seq:
+                    self.frames_dropped += 1
+                self._back, self._slot = self._slot, frame
+                self._seq += 1
+                self._timestamp = timestamp
+                self.frames_captured += 1
+                self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """Wait for a frame newer than the last one read.
+
+        Returns (ret, frame, seq, timestamp). The returned frame is a buffer that
+        is reused by the next call, copy it if it has to outlive the iteration.
+        Like cap.read() this waits as long as the capture thread is alive (a slow
+        first frame or a stalled camera is not the end of the stream); ret is False
+        at the end of the stream, on a read error, or after timeout seconds if given.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._seq <= self._consumed_seq and not self.failed and self.running:
+                if not self._thread.is_alive():
+                    break
+                remaining = 0.5 if deadline is None else min(0.5, deadline - time.time())
+                if remaining <= 0:
+                    return False, None, self._consumed_seq, 0.0
+                self._cond.wait(remaining)
+            if self._seq <= self._consumed_seq:
+                return False, None, self._consumed_seq, 0.0
+
+            if self._out is None or self._out.shape != self._slot.shape:
+                self._out = np.empty_like(self._slot)
+            np.copyto(self._out, self._slot)
+            self._consumed_seq = self._seq
+            return True, self._out, self._seq, self._timestamp
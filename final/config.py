@@ -0,0 +1,44 @@
+import copy
+import json
+
+# Defaults for values that can be set from a JSON config file.
+# 'edge_params', 'stability_params', 'sink_params' and 'clip_params' hold overrides for
+# EDGE_PARAMS / STABILITY_PARAMS / SINK_PARAMS / RECORDER_PARAMS.
+DEFAULT_CONFIG = {
+    'source': 1,
+    'cameras': [],  # sources (or dicts of per-camera overrides with an optional 'name') for multicam.py
+    'realtime': False,
+    'scale_range': 15,
+    'headless': False,
+    'output': '-',
+    'sinks': [],  # extra outputs fed without blocking: paths, udp://, tcp://, unix:// or redis:// URLs
+    'sink_params': {},
+    'clips': None,  # directory for clips around stable heights (single process only)
+    'clip_params': {},
+    'workers': 0,
+    'metrics_port': None,
+    'rois': [],  # (x0, y0, x1, y1) in pixels or frame fractions, empty for the full frame
+    'calibration': None,  # calibration JSON file, frames are undistorted when it has an entry for the camera
+    'camera_name': None,  # calibration key of the camera, defaults to the source
+    'undistort_fixed_point': True,
+    'undistort_rois_only': False,
+    'edge_params': {},
+    'stability_params': {},
+}
+
+def merge_config(base, overrides):
+    """Recursively merge overrides into a copy of base"""
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def load_config(path=None):
+    """Load a JSON config file on top of DEFAULT_CONFIG"""
+    if path is None:
+        return copy.deepcopy(DEFAULT_CONFIG)
+    with open(path) as f:
+        return merge_config(DEFAULT_CONFIG, json.load(f))
@@ -0,0 +1,332 @@
+import sys
+
+import cv2
+import numpy as np
+
+# Edge and line detection parameters
+EDGE_PARAMS = {'CANNY_THRESHOLDS': (30, 150), 'MIN_LINE_LENGTH': 100, 'MAX_LINE_GAP': 20, 'HOUGH_THRESHOLD': 30,
+               'PREPROCESS': 'bilateral', 'ADAPTIVE_BLOCK_SIZE': 11, 'MORPH_KERNEL': (25, 1),
+               'PYRAMID_LEVELS': 0, 'PYRAMID_MARGIN': 12, 'ENGINE': 'hough',
+               'PROJECTION_STRIPS': 1, 'PROJECTION_MIN_STRENGTH': 4.0, 'PROJECTION_MIN_PEAK': 0.3, 'PROJECTION_MIN_GAP': 5,
+               'SUBPIXEL': False, 'SUBPIXEL_RADIUS': 1, 'SUBPIXEL_SAMPLES': 64}
+
+# Compact record of a detected horizontal line: y_avg is the integer row used for drawing,
+# y_fine the (possibly sub-pixel) row the measurement uses
+LINE_DTYPE = np.dtype([('x1', np.int32), ('y1', np.int32), ('x2', np.int32), ('y2', np.int32), ('y_avg', np.int32),
+                       ('y_fine', np.float32)])
+
+def _downscale_then(filter_fn):
+    """Wrap a filter so it runs on a half-size image and is scaled back up"""
+    def chain(gray):
+        small = cv2.resize(gray, (gray.shape[1] // 2, gray.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        return cv2.resize(filter_fn(small), (gray.shape[1], gray.shape[0]), interpolation=cv2.INTER_LINEAR)
+    return chain
+
+# Named noise-reduction chains run on the grayscale frame before thresholding ('bilateral' is the original)
+PREPROCESS_CHAINS = {
+    'bilateral': lambda gray: cv2.bilateralFilter(gray, 9, 75, 75),
+    'gaussian': lambda gray: cv2.GaussianBlur(gray, (5, 5), 0),
+    'box': lambda gray: cv2.blur(gray, (5, 5)),
+    'median': lambda gray: cv2.medianBlur(gray, 5),
+    'half_bilateral': _downscale_then(lambda gray: cv2.bilateralFilter(gray, 5, 75, 75)),
+    'half_gaussian': _downscale_then(lambda gray: cv2.GaussianBlur(gray, (3, 3), 0)),
+    'none': lambda gray: gray,
+}
+
+def scale_geometry(width, height, scale_range):
+    """Return (scale_x, scale_y_bottom, pixels_per_cm) of the on-screen scale without drawing it"""
+    scale_x, scale_y_bottom = width - 70, height - 20
+    return scale_x, scale_y_bottom, (scale_y_bottom - 20) / scale_range
+
+# The edge detection chain as (stage name, EDGE_PARAMS keys it depends on, function(previous output, params));
+# every stage also depends on the keys of the stages before it
+EDGE_STAGES = [
+    ('cvtColor', (), lambda image, params: cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)),
+    ('filter', ('PREPROCESS',), lambda gray, params: PREPROCESS_CHAINS[params.get('PREPROCESS', 'bilateral')](gray)),
+    ('adaptiveThreshold', ('ADAPTIVE_BLOCK_SIZE',),
+     lambda filtered, params: cv2.adaptiveThreshold(filtered, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                                    params.get('ADAPTIVE_BLOCK_SIZE', 11), 2)),
+    ('morphologyEx', ('MORPH_KERNEL',),
+     lambda binary, params: cv2.morphologyEx(binary, cv2.MORPH_OPEN, cv2.getStructuringElement(
+         cv2.MORPH_RECT, tuple(params.get('MORPH_KERNEL', (25, 1)))))),
+    ('Canny', ('CANNY_THRESHOLDS',), lambda opened, params: cv2.Canny(opened, *params['CANNY_THRESHOLDS'])),
+]
+
+def detect_edges(frame, params=EDGE_PARAMS, timer=None):
+    """Run the edge detection chain on a BGR frame and return the edge map (timer: optional metrics.StageTimer)"""
+    image = frame
+    for name, _, stage in EDGE_STAGES:
+        image = stage(image, params)
+        if timer: timer.lap(name)
+    return image
+
+def filter_horizontal(lines, min_length, max_slope=0.1):
+    """Keep the HoughLinesP segments with |slope| < max_slope and length > min_length.
+
+    Works on the whole Nx4 result at once and returns a LINE_DTYPE array sorted top to bottom.
+    """
+    if lines is None or len(lines) == 0:
+        return np.empty(0, LINE_DTYPE)
+    x1, y1, x2, y2 = lines.reshape(-1, 4).astype(np.int64).T
+    dx, dy = x2 - x1, y2 - y1
+    keep = (dx != 0) & (np.abs(dy) < max_slope * np.abs(dx)) & (dx * dx + dy * dy > min_length * min_length)
+
+    horizontal_lines = np.empty(np.count_nonzero(keep), LINE_DTYPE)
+    horizontal_lines['x1'], horizontal_lines['y1'] = x1[keep], y1[keep]
+    horizontal_lines['x2'], horizontal_lines['y2'] = x2[keep], y2[keep]
+    horizontal_lines['y_avg'] = (y1[keep] + y2[keep]) // 2
+    horizontal_lines['y_fine'] = horizontal_lines['y_avg']
+    return horizontal_lines[np.argsort(horizontal_lines['y_avg'], kind='stable')]
+
+def shift_lines(lines, dx=0, dy=0, scale=1):
+    """Return a copy of LINE_DTYPE lines scaled by scale and then moved by (dx, dy)"""
+    shifted = lines.copy()
+    for field in ('x1', 'x2'):
+        shifted[field] = shifted[field] * scale + dx
+    for field in ('y1', 'y2', 'y_avg', 'y_fine'):
+        shifted[field] = shifted[field] * scale + dy
+    return shifted
+
+def find_horizontal_lines(edges, params=EDGE_PARAMS, timer=None):
+    """Detect line segments and return the near-horizontal ones sorted top to bottom"""
+    lines = cv2.HoughLinesP(edges, 1, np.pi/180, params['HOUGH_THRESHOLD'],
+                            minLineLength=params['MIN_LINE_LENGTH'], maxLineGap=params['MAX_LINE_GAP'])
+    if timer: timer.lap('HoughLinesP')
+    horizontal_lines = filter_horizontal(lines, params['MIN_LINE_LENGTH'])
+    if timer: timer.lap('line_filter')
+    return horizontal_lines
+
+def measure_lines(horizontal_lines, scale_y_bottom, pixels_per_cm):
+    """Turn the top and bottom horizontal lines into a measurement dict, None if fewer than two lines"""
+    if len(horizontal_lines) < 2:
+        return None
+    top_line, bottom_line = horizontal_lines[0], horizontal_lines[-1]
+    top_y, bot_y = float(top_line['y_fine']), float(bottom_line['y_fine'])
+    top_cm = (scale_y_bottom - top_y) / pixels_per_cm
+    bot_cm = (scale_y_bottom - bot_y) / pixels_per_cm
+    return {'top_line': top_line, 'bottom_line': bottom_line, 'top_y': top_y, 'bot_y': bot_y,
+            'top_cm': top_cm, 'bot_cm': bot_cm, 'height': top_cm - bot_cm, 'line_count': len(horizontal_lines)}
+
+def coarse_params(params, factor):
+    """Scale the length, vote and kernel parameters of EDGE_PARAMS for an image downscaled by factor"""
+    kernel_w, kernel_h = params.get('MORPH_KERNEL', (25, 1))
+    return dict(params, MIN_LINE_LENGTH=max(2, params['MIN_LINE_LENGTH'] // factor),
+                MAX_LINE_GAP=max(1, params['MAX_LINE_GAP'] // factor),
+                HOUGH_THRESHOLD=max(2, params['HOUGH_THRESHOLD'] // factor),
+                ADAPTIVE_BLOCK_SIZE=max(3, (params.get('ADAPTIVE_BLOCK_SIZE', 11) // factor) | 1),
+                MORPH_KERNEL=(max(3, kernel_w // factor), kernel_h))
+
+def refine_line(frame, line, factor, params, pick_top, timer=None):
+    """Re-detect a coarse line at full resolution inside a thin full-width strip around its row"""
+    height = frame.shape[0]
+    margin = params.get('PYRAMID_MARGIN', 12) + factor
+    y = int(line['y_avg']) * factor + factor // 2
+    xs0, ys0, ys1 = 0, max(0, y - margin), min(height, y + margin)
+    strip_edges = detect_edges(frame[ys0:ys1], params, timer)
+    strip_lines = find_horizontal_lines(strip_edges, params, timer)
+    if len(strip_lines) == 0:
+        return None, (xs0, ys0, strip_edges)
+    return shift_lines(strip_lines[:1] if pick_top else strip_lines[-1:], xs0, ys0), (xs0, ys0, strip_edges)
+
+def detect_pyramid(frame, params=EDGE_PARAMS, timer=None):
+    """Find candidate lines on a downscaled frame, then refine the top and bottom ones at full resolution.
+
+    Falls back to full-resolution detection when the coarse pass finds fewer than two bands more than a strip
+    (2 * margin rows) apart, or when the refined top and bottom end up within one strip: then the coarse
+    level has lost an edge and both lines would come from the same band.
+    """
+    def full_resolution():
+        full_edges = detect_edges(frame, params, timer)
+        return full_edges, find_horizontal_lines(full_edges, params, timer)
+
+    height, width = frame.shape[:2]
+    factor = 2 ** int(params['PYRAMID_LEVELS'])
+    small = cv2.resize(frame, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    if timer: timer.lap('resize')
+    small_edges = detect_edges(small, coarse_params(params, factor), timer)
+    candidates = find_horizontal_lines(small_edges, coarse_params(params, factor), timer)
+
+    # Coarse edges scaled up for display, refined strips pasted over them
+    edges = cv2.resize(small_edges, (width, height), interpolation=cv2.INTER_NEAREST)
+    horizontal_lines = shift_lines(candidates, scale=factor)
+    horizontal_lines['y_avg'] += factor // 2
+    horizontal_lines['y_fine'] += factor // 2
+    strip = 2 * (params.get('PYRAMID_MARGIN', 12) + factor)
+    if len(candidates) < 2 or (int(candidates['y_avg'][-1]) - int(candidates['y_avg'][0])) * factor <= strip:
+        return full_resolution()
+    refined_lines = []
+    for index, pick_top in [(0, True), (-1, False)]:
+        refined, (xs0, ys0, strip_edges) = refine_line(frame, candidates[index], factor, params, pick_top, timer)
+        edges[ys0:ys0 + strip_edges.shape[0], xs0:xs0 + strip_edges.shape[1]] = strip_edges
+        if refined is None:
+            refined = horizontal_lines[:1] if pick_top else horizontal_lines[-1:]
+        refined_lines.append(refined)
+
+    # Coarse candidates that fall into the refined strips are the same edges, keep only those in between
+    top_line, bottom_line = sorted(refined_lines, key=lambda line: line['y_avg'][0])
+    if bottom_line['y_fine'][0] - top_line['y_fine'][0] <= strip:
+        return full_resolution()
+    middle = horizontal_lines[1:-1]
+    middle = middle[(middle['y_avg'] > top_line['y_avg'][0]) & (middle['y_avg'] < bottom_line['y_avg'][0])]
+    return edges, np.concatenate((top_line, middle, bottom_line))
+
+def profile_peaks(profile, params=EDGE_PARAMS):
+    """Return sub-pixel row positions of the peaks of a 1-D gradient profile"""
+    if len(profile) < 3:
+        return np.empty(0, np.float32)
+    threshold = max(params['PROJECTION_MIN_STRENGTH'], params['PROJECTION_MIN_PEAK'] * float(profile.max()))
+
+    # Local maxima above the threshold that are also the maximum within PROJECTION_MIN_GAP rows
+    gap = int(params['PROJECTION_MIN_GAP'])
+    neighbourhood_max = cv2.dilate(profile.reshape(-1, 1), np.ones((2 * gap + 1, 1), np.uint8)).ravel()
+    is_peak = np.zeros(len(profile), bool)
+    is_peak[1:-1] = ((profile[1:-1] >= profile[:-2]) & (profile[1:-1] > profile[2:]) &
+                     (profile[1:-1] >= threshold) & (profile[1:-1] >= neighbourhood_max[1:-1]))
+    rows = np.flatnonzero(is_peak)
+
+    # Parabola through each peak and its neighbours
+    left, centre, right = profile[rows - 1], profile[rows], profile[rows + 1]
+    curvature = left - 2 * centre + right
+    offset = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, -1), 0)
+    return (rows + offset).astype(np.float32)
+
+def detect_projection(image, params=EDGE_PARAMS, timer=None):
+    """Find horizontal edges as peaks of the row-projected vertical gradient, optionally per vertical strip.
+
+    Each peak becomes a line spanning its strip, so the result plugs into measure_lines like the Hough lines.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if timer: timer.lap('cvtColor')
+    filtered = PREPROCESS_CHAINS[params.get('PREPROCESS', 'bilateral')](gray)
+    if timer: timer.lap('filter')
+    gradient = np.abs(cv2.Sobel(filtered, cv2.CV_32F, 0, 1, ksize=3))
+    if timer: timer.lap('Sobel')
+
+    width = gradient.shape[1]
+    bounds = np.linspace(0, width, max(1, int(params['PROJECTION_STRIPS'])) + 1).astype(int)
+    horizontal_lines = []
+    for x0, x1 in zip(bounds[:-1], bounds[1:]):
+        rows = profile_peaks(cv2.reduce(gradient[:, x0:x1], 1, cv2.REDUCE_AVG).ravel(), params)
+        strip_lines = np.empty(len(rows), LINE_DTYPE)
+        strip_lines['x1'], strip_lines['x2'] = x0, x1 - 1
+        strip_lines['y1'] = strip_lines['y2'] = strip_lines['y_avg'] = np.round(rows)
+        strip_lines['y_fine'] = rows
+        horizontal_lines.append(strip_lines)
+    horizontal_lines = np.concatenate(horizontal_lines)
+    if timer: timer.lap('projection')
+    return cv2.convertScaleAbs(gradient), horizontal_lines[np.argsort(horizontal_lines['y_fine'], kind='stable')]
+
+def detect_lines(image, params=EDGE_PARAMS, timer=None):
+    """Run the configured engine (Hough at full resolution or pyramid, or row projection) and return (edges, horizontal lines)"""
+    if params.get('ENGINE', 'hough') == 'projection':
+        return detect_projection(image, params, timer)
+    if params.get('PYRAMID_LEVELS', 0) > 0:
+        return detect_pyramid(image, params, timer)
+    edges = detect_edges(image, params, timer)
+    return edges, find_horizontal_lines(edges, params, timer)
+
+def resolve_roi(roi, width, height):
+    """Convert an (x0, y0, x1, y1) ROI to clipped pixel coordinates.
+
+    An ROI whose four values are all <= 1 is in fractions of the frame size, any other is in pixels,
+    so (0, 0.3, 1, 0.7) is the full-width band between 30% and 70% of the height.
+    """
+    if len(roi) != 4:
+        raise ValueError(f"ROI {roi} needs four values x0, y0, x1, y1")
+    fractions = all(value <= 1 for value in roi)
+
+    def to_pixels(value, size):
+        value = value * size if fractions else value
+        return int(min(max(round(value), 0), size))
+
+    x0, y0, x1, y1 = roi
+    x0, x1 = sorted((to_pixels(x0, width), to_pixels(x1, width)))
+    y0, y1 = sorted((to_pixels(y0, height), to_pixels(y1, height)))
+    return x0, y0, x1, y1
+
+# ROIs already reported as empty, so a configured one is reported once and not on every frame
+_empty_rois = set()
+
+def detect_in_rois(frame, rois, params=EDGE_PARAMS, timer=None):
+    """Run edge and line detection on each ROI crop only and return (edges, lines) in full-frame coordinates"""
+    height, width = frame.shape[:2]
+    edges = np.zeros((height, width), np.uint8)
+    horizontal_lines = [np.empty(0, LINE_DTYPE)]
+    for roi in rois:
+        x0, y0, x1, y1 = resolve_roi(roi, width, height)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            key = (tuple(roi), width, height)
+            if key not in _empty_rois:
+                _empty_rois.add(key)
+                print(f"Skipping ROI {list(roi)}: it is {x1 - x0}x{y1 - y0} px in a {width}x{height} frame", file=sys.stderr)
+            continue
+        roi_edges, roi_lines = detect_lines(frame[y0:y1, x0:x1], params, timer)
+        edges[y0:y1, x0:x1] = roi_edges
+        horizontal_lines.append(shift_lines(roi_lines, x0, y0))
+    horizontal_lines = np.concatenate(horizontal_lines)
+    return edges, horizontal_lines[np.argsort(horizontal_lines['y_fine'], kind='stable')]
+
+def subpixel_offset(frame, line, params=EDGE_PARAMS):
+    """Offset of the intensity edge from the middle of a segment, from the gradient profile sampled along it.
+
+    Rows around the segment are sampled bilinearly at up to SUBPIXEL_SAMPLES points and averaged along it.
+    Starting at the segment's row the central-difference gradient is climbed to the nearest local peak, which
+    is located with a parabola. Returns None when that peak is more than SUBPIXEL_RADIUS rows away, so a
+    stronger edge nearby never pulls the line onto itself.
+    """
+    x1, y1, x2, y2 = (float(line[field]) for field in ('x1', 'y1', 'x2', 'y2'))
+    radius = int(params['SUBPIXEL_RADIUS'])
+    xs = np.linspace(x1, x2, int(min(params['SUBPIXEL_SAMPLES'], abs(x2 - x1) + 1)), dtype=np.float32)
+    ys = y1 + (y2 - y1) * (xs - x1) / (x2 - x1) if x2 != x1 else np.full_like(xs, y1)
+    offsets = np.arange(-radius - 2, radius + 3, dtype=np.float32)
+    map_x = np.broadcast_to(xs, (len(offsets), len(xs)))
+    map_y = ys[None, :] + offsets[:, None]
+    patch = cv2.remap(frame, np.ascontiguousarray(map_x), map_y.astype(np.float32), cv2.INTER_LINEAR,
+                      borderMode=cv2.BORDER_REPLICATE)
+    if patch.ndim == 3:
+        patch = cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY)
+    profile = patch.astype(np.float32).mean(axis=1)
+    gradient = np.abs(profile[2:] - profile[:-2]) / 2  # At offsets -radius - 1 .. radius + 1
+
+    peak = radius + 1
+    while 0 < peak < len(gradient) - 1:
+        neighbour = peak + 1 if gradient[peak + 1] >= gradient[peak - 1] else peak - 1
+        if gradient[neighbour] <= gradient[peak]:
+            break
+        peak = neighbour
+    if peak == 0 or peak == len(gradient) - 1 or gradient[peak] <= 0:
+        return None
+    left, centre, right = gradient[peak - 1], gradient[peak], gradient[peak + 1]
+    curvature = left - 2 * centre + right
+    shift = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+    offset = float(peak - radius - 1 + shift)
+    return offset if abs(offset) <= radius else None
+
+def refine_subpixel(frame, horizontal_lines, params=EDGE_PARAMS):
+    """Move the top and bottom lines to the sub-pixel row of the intensity edge they sit on (y_fine, rounded into y_avg);
+    a line without such an edge within SUBPIXEL_RADIUS rows keeps its integer row"""
+    if len(horizontal_lines) == 0:
+        return horizontal_lines
+    horizontal_lines = horizontal_lines.copy()
+    for index in {0, len(horizontal_lines) - 1}:
+        line = horizontal_lines[index]
+        offset = subpixel_offset(frame, line, params)
+        if offset is not None:
+            y_fine = (float(line['y1']) + float(line['y2'])) / 2 + offset
+            horizontal_lines['y_fine'][index], horizontal_lines['y_avg'][index] = y_fine, round(y_fine)
+    return horizontal_lines
+
+def measure_frame(frame, scale_range, params=EDGE_PARAMS, rois=None, timer=None):
+    """Run detection on a frame (or only inside the given ROIs) and return (edges, measurement or None)"""
+    height, width = frame.shape[:2]
+    _, scale_y_bottom, pixels_per_cm = scale_geometry(width, height, scale_range)
+    if rois:
+        edges, horizontal_lines = detect_in_rois(frame, rois, params, timer)
+    else:
+        edges, horizontal_lines = detect_lines(frame, params, timer)
+
+    # The projection engine is sub-pixel already, Hough lines sit on whole rows
+    if params.get('SUBPIXEL', False) and params.get('ENGINE', 'hough') != 'projection':
+        horizontal_lines = refine_subpixel(frame, horizontal_lines, params)
+        if timer: timer.lap('subpixel')
+    return edges, measure_lines(horizontal_lines, scale_y_bottom, pixels_per_cm)
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# One fixed-size record per frame (40 bytes). Frames without a measurement have NaN height and rows,
+# stable marks the frame a stable height was reported on (stable_height, NaN elsewhere)
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('seq', '<i8'), ('height', '<f4'), ('stable_height', '<f4'),
+                         ('top_y', '<f4'), ('bot_y', '<f4'), ('line_count', '<u2'), ('camera', '<u2'),
+                         ('measured', 'u1'), ('stable', 'u1'), ('reserved', 'V2')])
+
+# One entry per written chunk: the segment file and record range it went to and the time span it covers
+# (sorted is always set by this writer, which orders every chunk by timestamp; logs of older writers may not be)
+INDEX_DTYPE = np.dtype([('segment', '<u4'), ('start', '<u4'), ('count', '<u4'), ('sorted', 'u1'), ('reserved', 'V3'),
+                        ('first_time', '<f8'), ('last_time', '<f8')])
+
+# Records per chunk write, records per segment file (about 40 MB, 9.7 hours at 30 fps) and
+# most seconds a record waits in memory before its chunk is written
+LOG_PARAMS = {'CHUNK_RECORDS': 1024, 'SEGMENT_RECORDS': 1 << 20, 'FLUSH_SECONDS': 10.0}
+
+INDEX_FILE = 'index.bin'
+META_FILE = 'meta.json'
+
+def segment_path(path, segment):
+    return os.path.join(path, f"{segment:06d}.bin")
+
+def read_index(path):
+    """All complete index entries of a log directory"""
+    index_path = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return np.zeros(0, INDEX_DTYPE)
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    return np.frombuffer(data[:len(data) - len(data) % INDEX_DTYPE.itemsize], INDEX_DTYPE)
+
+def read_meta(path):
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return {'record_size': RECORD_DTYPE.itemsize, 'cameras': []}
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['record_size'] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} holds {meta['record_size']} byte records, expected {RECORD_DTYPE.itemsize}")
+    return meta
+
+class MeasurementLogWriter:
+    """Appends frame and stable records to a log directory, a chunk of records at a time.
+
+    Records go to numbered segment files; after every chunk an index entry is appended, so readers only
+    ever see whole chunks and a chunk cut short by a crash is dropped when the log is opened again.
+    Each chunk is sorted by timestamp when it is written (interleaved cameras arrive slightly out of order),
+    so any time range of a chunk is a contiguous slice.
+    """
+
+    def __init__(self, path, params=None):
+        self.path, self.params = path, dict(LOG_PARAMS, **(params or {}))
+        os.makedirs(path, exist_ok=True)
+        self.cameras = {name: number for number, name in enumerate(read_meta(path)['cameras'])}
+
+        # Continue after the last indexed chunk, anything written past it is cut off
+        index = read_index(path)
+        self.segment, self.segment_count = 0, 0
+        if len(index):
+            last = index[-1]
+            self.segment, self.segment_count = int(last['segment']), int(last['start'] + last['count'])
+        self.segment_file = open(segment_path(path, self.segment), 'ab')
+        self.segment_file.truncate(self.segment_count * RECORD_DTYPE.itemsize)
+        self.index_file = open(os.path.join(path, INDEX_FILE), 'ab')
+        self.index_file.truncate(len(index) * INDEX_DTYPE.itemsize)
+
+        self.buffer, self.count, self.buffered_since = np.zeros(self.params['CHUNK_RECORDS'], RECORD_DTYPE), 0, None
+
+    def camera_number(self, name):
+        """Number of a camera name, new names are added to meta.json"""
+        name = '' if name is None else str(name)
+        if name not in self.cameras:
+            self.cameras[name] = len(self.cameras)
+            temp_path = os.path.join(self.path, META_FILE + '.tmp')
+            with open(temp_path, 'w') as f:
+                json.dump({'record_size': RECORD_DTYPE.itemsize, 'cameras': list(self.cameras)}, f)
+            os.replace(temp_path, os.path.join(self.path, META_FILE))
+        return self.cameras[name]
+
+    def append(self, record):
+        """Add one record as written by Height_detection ('frame' or 'stable' type)"""
+        camera = self.camera_number(record.get('camera'))
+        if record.get('type') == 'stable':
+            # Mark the frame the stable height was measured on, it is normally still buffered
+            # (other cameras' frames may come in between); otherwise the report gets a row of its own
+            buffered = self.buffer[:self.count]
+            found = np.nonzero((buffered['seq'] == record['seq']) & (buffered['camera'] == camera))[0]
+            row = self.buffer[found[-1]] if len(found) else self._next_row(record, camera)
+            row['stable'], row['stable_height'] = 1, record['height']
+            return
+        row = self._next_row(record, camera)
+        if record.get('height') is not None:
+            row['measured'] = 1
+            row['height'], row['top_y'], row['bot_y'] = record['height'], record['top_y'], record['bot_y']
+            row['line_count'] = record['line_count']
+
+    def _next_row(self, record, camera):
+        # Full or old chunks are written before a new frame starts, so a stable report still finds its frame
+        if self.count == len(self.buffer) or (self.count and time.time() - self.buffered_since >= self.params['FLUSH_SECONDS']):
+            self.flush()
+        if self.count == 0:
+            self.buffered_since = time.time()
+        row = self.buffer[self.count]
+        row['timestamp'], row['seq'], row['camera'] = record['timestamp'], record['seq'], camera
+        row['height'] = row['stable_height'] = row['top_y'] = row['bot_y'] = np.nan
+        row['line_count'] = row['measured'] = row['stable'] = 0
+        self.count += 1
+        return row
+
+    def flush(self):
+        """Write the buffered records as one chunk and index it"""
+        if not self.count:
+            return
+        chunk = self.buffer[:self.count]
+        chunk = chunk[np.argsort(chunk['timestamp'], kind='stable')]
+        if self.segment_count >= self.params['SEGMENT_RECORDS']:
+            self.segment_file.close()
+            self.segment, self.segment_count = self.segment + 1, 0
+            self.segment_file = open(segment_path(self.path, self.segment), 'ab')
+        self.segment_file.write(chunk.tobytes())
+        self.segment_file.flush()
+
+        times = chunk['timestamp']
+        entry = np.zeros(1, INDEX_DTYPE)
+        entry['segment'], entry['start'], entry['count'] = self.segment, self.segment_count, self.count
+        entry['sorted'] = 1
+        entry['first_time'], entry['last_time'] = times[0], times[-1]
+        self.index_file.write(entry.tobytes())
+        self.index_file.flush()
+        self.segment_count += self.count
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.segment_file.close()
+        self.index_file.close()
+
+class MeasurementLog:
+    """Read access to a log directory: segment files are memory-mapped and time ranges come back as views"""
+
+    def __init__(self, path):
+        self.path, self.segments = path, {}
+        self.refresh()
+
+    def refresh(self):
+        """Pick up chunks written since the log was opened"""
+        self.index = read_index(self.path)
+        self.cameras = read_meta(self.path)['cameras']
+        ends = self.index['start'] + self.index['count']
+        self.lengths = {int(number): int(ends[self.index['segment'] == number].max()) for number in np.unique(self.index['segment'])}
+
+    def __len__(self):
+        return int(self.index['count'].sum())
+
+    def segment(self, number):
+        """Memory map of the indexed records of one segment file"""
+        length = self.lengths[number]
+        if self.segments.get(number, (None, 0))[1] != length:
+            self.segments[number] = (np.memmap(segment_path(self.path, number), RECORD_DTYPE, mode='r', shape=(length,)), length)
+        return self.segments[number][0]
+
+    def slices(self, start=-np.inf, end=np.inf):
+        """Records with start <= timestamp < end as a list of arrays, one per run of neighbouring chunks.
+
+        Each array is in time order and a zero-copy view of the segment file, except for unsorted chunks of
+        logs from older writers, which are filtered into copies. The time spans of successive arrays can
+        overlap when cameras were interleaved, query() merges them in time order.
+        """
+        index = self.index
+        chosen = index[(index['last_time'] >= start) & (index['first_time'] < end)]
+        pieces, run = [], None
+        for segment, first, count, is_sorted, _, first_time, last_time in chosen.tolist():
+            records, last = self.segment(segment), first + count
+            if is_sorted:
+                # Only chunks the range starts or ends in are searched, the others are taken whole
+                lo, hi = first, last
+                if first_time < start:
+                    lo = first + int(np.searchsorted(records['timestamp'][first:last], start, 'left'))
+                if last_time >= end:
+                    hi = first + int(np.searchsorted(records['timestamp'][first:last], end, 'left'))
+                # Neighbouring chunks of one segment become one slice while their time spans follow each other
+                if run is not None and run[0] == segment and run[2] == lo and run[3] <= first_time:
+                    run[2], run[3] = hi, last_time
+                else:
+                    if run is not None:
+                        pieces.append(self.segment(run[0])[run[1]:run[2]])
+                    run = [segment, lo, hi, last_time]
+            else:
+                if run is not None:
+                    pieces.append(self.segment(run[0])[run[1]:run[2]])
+                    run = None
+                part = records[first:last]
+                part = part[(part['timestamp'] >= start) & (part['timestamp'] < end)]
+                pieces.append(part[np.argsort(part['timestamp'], kind='stable')])
+        if run is not None:
+            pieces.append(self.segment(run[0])[run[1]:run[2]])
+        return [piece for piece in pieces if len(piece)]
+
+    def query(self, start=-np.inf, end=np.inf, camera=None):
+        """Records with start <= timestamp < end (of one camera name when given) as a single array"""
+        pieces = self.slices(start, end)
+        records = pieces[0] if len(pieces) == 1 else np.concatenate(pieces) if pieces else np.zeros(0, RECORD_DTYPE)
+        if len(pieces) > 1 and np.any(np.diff(records['timestamp']) < 0):
+            records = records[np.argsort(records['timestamp'], kind='stable')]
+        if camera is not None:
+            number = self.cameras.index(str(camera)) if str(camera) in self.cameras else -1
+            records = records[records['camera'] == number]
+        return records
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a binary measurement log by time range')
+    parser.add_argument('path', type=str, help='Log directory')
+    parser.add_argument('--start', type=float, default=-np.inf, help='First timestamp (seconds, inclusive)')
+    parser.add_argument('--end', type=float, default=np.inf, help='Last timestamp (seconds, exclusive)')
+    parser.add_argument('--camera', type=str, help='Only records of this camera name')
+    parser.add_argument('--jsonl', action='store_true', help='Print the records as JSON lines')
+    args = parser.parse_args()
+
+    log = MeasurementLog(args.path)
+    start = time.perf_counter()
+    records = log.query(args.start, args.end, args.camera)
+    elapsed = time.perf_counter() - start
+    if args.jsonl:
+        for row in records:
+            record = {'timestamp': float(row['timestamp']), 'seq': int(row['seq']), 'stable': bool(row['stable'])}
+            if log.cameras:
+                record['camera'] = log.cameras[row['camera']]
+            if row['measured']:
+                record.update(height=float(row['height']), top_y=float(row['top_y']), bot_y=float(row['bot_y']),
+                              line_count=int(row['line_count']))
+            if row['stable']:
+                record['stable_height'] = float(row['stable_height'])
+            print(json.dumps(record))
+    measured = records[records['measured'] == 1]
+    stable = records[records['stable'] == 1]
+    print(f"{len(records)} of {len(log)} records in {1000 * elapsed:.2f} ms, {len(measured)} measured, "
+          f"{len(stable)} stable heights", file=sys.stderr)
+    if len(records):
+        print(f"time {records['timestamp'].min():.3f} .. {records['timestamp'].max():.3f}", file=sys.stderr)
+    if len(measured):
+        heights = measured['height']
+        print(f"height mean {heights.mean():.2f} min {heights.min():.2f} max {heights.max():.2f}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
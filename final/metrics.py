@@ -0,0 +1,126 @@
+import bisect
+import collections
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = 'height_detection'
+
+class Metrics:
+    """Per-stage latency histograms and event counters rendered in the Prometheus text format"""
+
+    def __init__(self, window=2048):
+        self.window = window
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        """Add to a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """Set a gauge"""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        """Record one stage duration"""
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0,
+                                                      'recent': collections.deque(maxlen=self.window)}
+            index = bisect.bisect_left(BUCKETS, seconds)
+            if index < len(BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            histogram['recent'].append(seconds)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters, gauges = list(self.counters.items()), list(self.gauges.items())
+            histograms = [(stage, dict(h, buckets=list(h['buckets']), recent=list(h['recent'])))
+                          for stage, h in self.histograms.items()]
+        lines = []
+        for name, value in counters:
+            lines += [f"# TYPE {PREFIX}_{name}_total counter", f"{PREFIX}_{name}_total {value}"]
+        for name, value in gauges:
+            lines += [f"# TYPE {PREFIX}_{name} gauge", f"{PREFIX}_{name} {value}"]
+
+        name = f"{PREFIX}_stage_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, h in histograms:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {h["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {h["sum"]:.9f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {h["count"]}')
+
+        # Quantiles over the most recent samples of each stage
+        lines.append(f"# TYPE {name}_recent gauge")
+        for stage, h in histograms:
+            if h['recent']:
+                for quantile, value in zip(QUANTILES, np.percentile(h['recent'], [q * 100 for q in QUANTILES])):
+                    lines.append(f'{name}_recent{{stage="{stage}",quantile="{quantile}"}} {value:.9f}')
+        return "\n".join(lines) + "\n"
+
+class StageTimer:
+    """Lap timer for one frame: lap(stage) charges the time since the previous lap to that stage.
+
+    Code under measurement takes timer=None and only calls lap() when a timer is given,
+    so a disabled timer costs nothing but the None check.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.frame = {}
+        self.last = time.perf_counter()
+
+    def begin(self):
+        """Start timing a new frame"""
+        self.frame.clear()
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.frame[stage] = self.frame.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def end(self):
+        """Record this frame's stage totals in the histograms, once per begin()"""
+        for stage, seconds in self.frame.items():
+            self.metrics.observe(stage, seconds)
+        self.frame.clear()
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    """Serve metrics.render() on http://host:port/metrics from a daemon thread and return the server"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
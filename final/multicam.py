@@ -0,0 +1,281 @@
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from calibration import config_undistorter
+from config import load_config, merge_config
+from detection import EDGE_PARAMS, resolve_roi, measure_frame
+from Height_detection import frame_record, write_record
+from pipeline import STOP, _attach_ring, child_message
+from sinks import open_output, close_output
+from sources import open_source
+from stabilizer import HeightStabilizer
+
+# First element of the message a capture process sends to the collector when its source ends
+END = 'end'
+
+def camera_configs(config):
+    """One full config per camera: config['cameras'] entries are sources or dicts of per-camera overrides"""
+    cameras = []
+    for camera in config['cameras'] or [config['source']]:
+        overrides = camera if isinstance(camera, dict) else {'source': camera}
+        camera_config = merge_config(config, overrides)
+        del camera_config['cameras']
+        camera_config['name'] = str(camera_config.get('name') or camera_config['source'])
+        cameras.append(camera_config)
+    return cameras
+
+def camera_capture_process(camera, spec, realtime, control, ring_info, free_slots, tasks, results):
+    """Read one camera into its ring slots and queue (camera, order, seq, timestamp, slot, queued_at) tasks"""
+    source = open_source(spec, realtime=realtime)
+    ret, frame, seq, timestamp = source.read() if source.isOpened() else (False, None, 0, 0.0)
+    if not ret:
+        control.put(STOP)
+        return
+
+    # The main process allocates the ring once it knows the frame size
+    control.put((frame.shape, frame.dtype.str))
+    shm, ring = _attach_ring(*ring_info.get(), frame.shape, frame.dtype)
+    order, dropped = 0, 0
+    try:
+        while ret:
+            if frame.shape != ring.shape[1:]:
+                print(f"Skipping frame {seq} of camera {spec}: size {frame.shape} differs from {ring.shape[1:]}",
+                      file=sys.stderr)
+            else:
+                # Every camera owns the same number of slots, so none can fill the shared task queue alone;
+                # live cameras drop frames when their slots are busy, recordings wait
+                try:
+                    slot = free_slots.get(block=not source.live)
+                except queue.Empty:
+                    dropped += 1
+                else:
+                    ring[slot] = frame
+                    order += 1
+                    tasks.put((camera, order, seq, timestamp, slot, time.time()))
+            ret, frame, seq, timestamp = source.read()
+    finally:
+        results.put((END, camera, order, {'frames_captured': source.frames_captured,
+                                          'frames_dropped': source.frames_dropped + dropped}))
+        source.release()
+        del ring
+        shm.close()
+
+def pool_worker_process(rings, free_slots, tasks, results, cameras):
+    """Measure frames of any camera straight out of its ring, with that camera's settings"""
+    # One OpenCV thread per worker, the parallelism comes from the processes
+    cv2.setNumThreads(1)
+    attached = {camera: _attach_ring(*ring_info) for camera, ring_info in rings.items()}
+    settings = {}
+    for camera, (shm, ring) in attached.items():
+        config = cameras[camera]
+        height, width = ring.shape[1:3]
+        undistort_rois = None
+        if config['undistort_rois_only'] and config['rois']:
+            undistort_rois = [resolve_roi(roi, width, height) for roi in config['rois']]
+        settings[camera] = (max(1, int(config['scale_range'])), dict(EDGE_PARAMS, **config['edge_params']),
+                            config['rois'], config_undistorter(config, width, height), undistort_rois)
+    try:
+        while True:
+            task = tasks.get()
+            if task is STOP:
+                break
+            camera, order, seq, timestamp, slot, queued_at = task
+            ring = attached[camera][1]
+            scale_range, edge_params, rois, undistorter, undistort_rois = settings[camera]
+            # A frame that fails still returns its slot and its order number, or its camera would stall
+            try:
+                frame = ring[slot] if undistorter is None else undistorter.apply(ring[slot], undistort_rois)
+                _, measurement = measure_frame(frame, scale_range, edge_params, rois)
+            except Exception as error:
+                print(f"Frame {seq} of camera {cameras[camera]['name']} could not be measured: {error!r}", file=sys.stderr)
+                measurement = None
+            free_slots[camera].put(slot)
+            if measurement is not None:
+                measurement = {key: measurement[key] for key in ('height', 'top_y', 'bot_y', 'line_count')}
+            results.put((camera, order, seq, timestamp, queued_at, measurement))
+    finally:
+        results.put(STOP)
+        for shm, ring in attached.values():
+            del ring
+            shm.close()
+
+class CameraStats:
+    """Frames, rate and lag (capture to result, in frame order) of one camera"""
+
+    def __init__(self, name):
+        self.name, self.frames, self.measured, self.lag_sum, self.lag_max = name, 0, 0, 0.0, 0.0
+        self.start, self.last, self.capture = time.time(), None, None
+
+    def add(self, queued_at, measured):
+        self.last = time.time()
+        lag = self.last - queued_at
+        self.frames += 1
+        self.measured += int(measured)
+        self.lag_sum += lag
+        self.lag_max = max(self.lag_max, lag)
+
+    def summary(self):
+        elapsed = max((self.last or time.time()) - self.start, 1e-9)
+        text = (f"{self.name}: {self.frames} frames ({self.measured} measured), {self.frames / elapsed:.1f} fps, "
+                f"lag {1000 * self.lag_sum / max(self.frames, 1):.1f} ms mean / {1000 * self.lag_max:.1f} ms max")
+        if self.capture:
+            text += f", captured {self.capture['frames_captured']}, dropped {self.capture['frames_dropped']}"
+        return text
+
+def run_cameras(config, workers, on_frame, on_stable, report_every=None):
+    """Measure several cameras with one capture process each and a shared pool of measuring workers.
+
+    on_frame(name, seq, timestamp, measurement) and on_stable(name, seq, timestamp, height) are called in
+    frame order per camera, each camera with its own stabilizer. Returns the CameraStats of every camera.
+    """
+    ctx = mp.get_context('spawn')
+    cameras = camera_configs(config)
+    slots = max(2, -(-2 * workers // len(cameras)))
+    tasks, results = ctx.Queue(), ctx.Queue()
+    free_slots = [ctx.Queue() for _ in cameras]
+    captures, controls, ring_queues = [], [], []
+    for camera, camera_config in enumerate(cameras):
+        control, ring_queue = ctx.Queue(), ctx.Queue()
+        process = ctx.Process(target=camera_capture_process, name=f"capture-{camera_config['name']}", daemon=True,
+                              args=(camera, camera_config['source'], camera_config['realtime'], control, ring_queue,
+                                    free_slots[camera], tasks, results))
+        process.start()
+        captures.append(process)
+        controls.append(control)
+        ring_queues.append(ring_queue)
+
+    # Shared-memory ring of frame slots per camera, frames are never pickled
+    shms, rings = [], {}
+    for camera, camera_config in enumerate(cameras):
+        try:
+            first = child_message(controls[camera], captures[camera])
+        except RuntimeError:
+            for process in captures:
+                process.terminate()
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+            raise
+        if first is STOP:
+            print(f"Error: Could not read from source {camera_config['source']}", file=sys.stderr)
+            continue
+        shape, dtype = first
+        shm = shared_memory.SharedMemory(create=True, size=slots * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        shms.append(shm)
+        rings[camera] = (shm.name, slots, shape, dtype)
+        for slot in range(slots):
+            free_slots[camera].put(slot)
+        ring_queues[camera].put(rings[camera][:2])
+    stats = {camera: CameraStats(cameras[camera]['name']) for camera in rings}
+    if not rings:
+        return stats
+
+    pool = [ctx.Process(target=pool_worker_process, name=f'worker-{i}', daemon=True,
+                        args=(rings, free_slots, tasks, results, cameras))
+            for i in range(workers)]
+    for process in pool:
+        process.start()
+
+    # Collect results and hand them to each camera's stabilizer in that camera's frame order
+    stabilizers = {camera: HeightStabilizer(cameras[camera]['stability_params']) for camera in rings}
+    pending = {camera: {} for camera in rings}
+    next_order = {camera: 1 for camera in rings}
+    last_order, running, stopping, last_report = {}, workers, False, time.time()
+    try:
+        while running:
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in pool):
+                    print("Error: all workers exited", file=sys.stderr)
+                    break
+                continue
+            if result is STOP:
+                running -= 1
+                continue
+            if result[0] == END:
+                _, camera, last, capture_stats = result
+                last_order[camera] = last
+                stats[camera].capture = capture_stats
+            else:
+                camera = result[0]
+                pending[camera][result[1]] = result
+            while next_order[camera] in pending[camera]:
+                _, _, seq, timestamp, queued_at, measurement = pending[camera].pop(next_order[camera])
+                next_order[camera] += 1
+                stats[camera].add(queued_at, measurement is not None)
+                on_frame(cameras[camera]['name'], seq, timestamp, measurement)
+                if measurement is not None:
+                    stable_height = stabilizers[camera].update(measurement['height'], timestamp)
+                    if stable_height is not None:
+                        on_stable(cameras[camera]['name'], seq, timestamp, stable_height)
+
+            # Once every camera has ended and all its frames are in, the workers can stop
+            if not stopping and len(last_order) == len(rings) and all(next_order[c] > last_order[c] for c in rings):
+                for _ in range(running):
+                    tasks.put(STOP)
+                stopping = True
+            if report_every and time.time() - last_report >= report_every:
+                for camera_stats in stats.values():
+                    print(camera_stats.summary(), file=sys.stderr)
+                last_report = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in captures + pool:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure heights from several cameras with one shared pool of worker processes')
+    parser.add_argument('--config', type=str, help="Path to a JSON config file ('cameras' lists the sources)")
+    parser.add_argument('--source', type=str, action='append', help='Camera index, video file, image directory or glob (repeat per camera)')
+    parser.add_argument('--workers', type=int, help='Measuring processes shared by all cameras (default: CPU count)')
+    parser.add_argument('--realtime', action='store_true', help='Pace recorded sources at their frame rate instead of max speed')
+    parser.add_argument('--output', type=str, help="JSON lines output file, '-' for stdout")
+    parser.add_argument('--sink', type=str, action='append',
+                        help='Also send measurements to a file, udp://host:port, tcp://host:port, unix:///path or redis://host:port/channel (repeatable)')
+    parser.add_argument('--scale-range', type=int, help='Scale range in cm')
+    parser.add_argument('--report-every', type=float, default=10.0, help='Seconds between per-camera fps and lag reports')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    for key, value in [('cameras', args.source), ('output', args.output), ('workers', args.workers),
+                       ('scale_range', args.scale_range)]:
+        if value is not None:
+            config[key] = value
+    config['realtime'] = config['realtime'] or args.realtime
+    if args.sink:
+        config['sinks'] = config['sinks'] + args.sink
+    workers = config['workers'] or os.cpu_count()
+
+    # One tagged result stream for all cameras
+    out = open_output(config)
+    try:
+        def on_frame(name, seq, timestamp, measurement):
+            write_record(out, dict(frame_record(seq, timestamp, measurement), camera=name))
+
+        def on_stable(name, seq, timestamp, height):
+            write_record(out, {'type': 'stable', 'camera': name, 'seq': seq, 'timestamp': timestamp, 'height': height})
+
+        stats = run_cameras(config, workers, on_frame, on_stable, args.report_every)
+    finally:
+        close_output(out)
+    for camera_stats in stats.values():
+        print(camera_stats.summary(), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import functools
+
+import cv2
+import numpy as np
+
+from detection import scale_geometry
+
+SCALE_COLOR = (0, 0, 255)
+
+def draw_scale(frame, scale_x, scale_y_bottom, scale_range, units='cm'):
+    """Draw measurement scale on the frame with given range in cm or mm"""
+    height, width = frame.shape[:2]
+    scale_y_top, scale_height = 20, scale_y_bottom - 20
+
+    # Draw main scale line
+    cv2.line(frame, (scale_x, 0), (scale_x, height), SCALE_COLOR, 2)
+    pixels_per_unit = scale_height / scale_range
+
+    if units == 'mm':
+        # Major ticks every 5/10/20/50 cm, drawn in 10 mm steps
+        major_tick = 50 if scale_range <= 250 else (100 if scale_range <= 500 else (200 if scale_range <= 1000 else 500))
+        for i in range(0, scale_range + 1, 10):
+            y_pos = int(scale_y_bottom - i * pixels_per_unit)
+            if i % major_tick == 0:  # Major ticks
+                cv2.line(frame, (scale_x - 12, y_pos), (scale_x, y_pos), SCALE_COLOR, 2)
+                cv2.putText(frame, f"{i} mm", (scale_x - 60, y_pos + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, SCALE_COLOR, 2)
+            elif i % (major_tick // 5) == 0 and scale_range <= 500:  # Medium ticks
+                cv2.line(frame, (scale_x - 8, y_pos), (scale_x, y_pos), SCALE_COLOR, 1)
+                cv2.putText(frame, f"{i}", (scale_x - 25, y_pos + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.3, SCALE_COLOR, 1)
+            elif scale_range <= 250:  # Minor ticks for smaller ranges
+                cv2.line(frame, (scale_x - 4, y_pos), (scale_x, y_pos), SCALE_COLOR, 1)
+        cv2.putText(frame, f"Scale (0-{scale_range}mm)", (scale_x - 120, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.6, SCALE_COLOR, 2)
+        return pixels_per_unit
+
+    # Set tick intervals based on scale range
+    major_tick = 5 if scale_range <= 25 else (10 if scale_range <= 50 else (20 if scale_range <= 100 else 50))
+
+    # Draw tick marks and labels
+    for i in range(scale_range + 1):
+        y_pos = int(scale_y_bottom - i * pixels_per_unit)
+
+        if i % major_tick == 0:  # Major ticks
+            cv2.line(frame, (scale_x - 12, y_pos), (scale_x, y_pos), SCALE_COLOR, 2)
+            cv2.putText(frame, f"{i} cm", (scale_x - 50, y_pos + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, SCALE_COLOR, 2)
+        elif i % (major_tick // 5) == 0 and scale_range <= 50:  # Medium ticks
+            cv2.line(frame, (scale_x - 8, y_pos), (scale_x, y_pos), SCALE_COLOR, 1)
+            cv2.putText(frame, f"{i}", (scale_x - 20, y_pos + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.3, SCALE_COLOR, 1)
+        elif scale_range <= 25:  # Minor ticks
+            cv2.line(frame, (scale_x - 4, y_pos), (scale_x, y_pos), SCALE_COLOR, 1)
+
+    cv2.putText(frame, f"Scale (0-{scale_range}cm)", (scale_x - 100, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.6, SCALE_COLOR, 2)
+    return pixels_per_unit
+
+@functools.lru_cache(maxsize=8)
+def render_scale(scale_range, width, height, units='cm'):
+    """Render the scale once into (x0, y0, layer, mask), cropped to the bounding box of the drawn pixels"""
+    layer = np.zeros((height, width, 3), np.uint8)
+    scale_x, scale_y_bottom, _ = scale_geometry(width, height, scale_range)
+    draw_scale(layer, scale_x, scale_y_bottom, scale_range, units)
+    mask = layer.any(axis=2).astype(np.uint8)
+    x0, y0, box_w, box_h = cv2.boundingRect(mask)
+    layer, mask = layer[y0:y0 + box_h, x0:x0 + box_w].copy(), mask[y0:y0 + box_h, x0:x0 + box_w].copy()
+    layer.flags.writeable = mask.flags.writeable = False
+    return x0, y0, layer, mask
+
+def composite_scale(frame, scale_range, units='cm'):
+    """Copy the cached scale onto the frame with one masked copy and return the pixels per unit"""
+    height, width = frame.shape[:2]
+    x0, y0, layer, mask = render_scale(scale_range, width, height, units)
+    cv2.copyTo(layer, mask, frame[y0:y0 + layer.shape[0], x0:x0 + layer.shape[1]])
+    return scale_geometry(width, height, scale_range)[2]
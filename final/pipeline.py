@@ -0,0 +1,185 @@
+import multiprocessing as mp
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from calibration import config_undistorter
+from detection import EDGE_PARAMS, resolve_roi, measure_frame
+from sources import open_source
+from stabilizer import HeightStabilizer
+
+# Message sent through the task and result queues when a process is done
+STOP = None
+
+def _attach_ring(name, slots, shape, dtype):
+    """Attach to the shared-memory frame ring and return (shm, array of shape (slots,) + shape)"""
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray((slots,) + tuple(shape), dtype=dtype, buffer=shm.buf)
+
+def child_message(messages, process, poll=1.0):
+    """Next message from a child process, raising RuntimeError when the child exits without sending one"""
+    while True:
+        try:
+            return messages.get(timeout=poll)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # A message sent just before exiting may still be on its way
+        try:
+            return messages.get(timeout=0.1)
+        except queue.Empty:
+            raise RuntimeError(f"Process {process.name} exited (code {process.exitcode}) before reporting, see its error above")
+
+def capture_process(spec, realtime, control, ring_info, free_slots, tasks, workers, stats):
+    """Read frames into free ring slots and queue (order, seq, timestamp, slot) tasks for the workers"""
+    source = open_source(spec, realtime=realtime)
+    ret, frame, seq, timestamp = source.read() if source.isOpened() else (False, None, 0, 0.0)
+    if not ret:
+        control.put(STOP)
+        for _ in range(workers):
+            tasks.put(STOP)
+        return
+
+    # The main process allocates the ring once it knows the frame size
+    control.put((frame.shape, frame.dtype.str))
+    shm, ring = _attach_ring(*ring_info.get(), frame.shape, frame.dtype)
+    order, dropped = 0, 0
+    try:
+        while ret:
+            if frame.shape != ring.shape[1:]:
+                print(f"Skipping frame {seq}: size {frame.shape} differs from {ring.shape[1:]}", file=sys.stderr)
+            else:
+                # Live cameras never wait for a slot (the frame is dropped), recordings wait so none is lost
+                try:
+                    slot = free_slots.get(block=not source.live)
+                except queue.Empty:
+                    dropped += 1
+                else:
+                    ring[slot] = frame
+                    order += 1
+                    tasks.put((order, seq, timestamp, slot))
+            ret, frame, seq, timestamp = source.read()
+    finally:
+        for _ in range(workers):
+            tasks.put(STOP)
+        stats.put({'frames_captured': source.frames_captured, 'frames_dropped': source.frames_dropped + dropped})
+        source.release()
+        del ring
+        shm.close()
+
+def worker_process(ring_info, free_slots, tasks, results, scale_range, edge_params, rois, config):
+    """Measure frames straight out of the ring and send back small result dicts"""
+    # One OpenCV thread per worker, the parallelism comes from the processes
+    cv2.setNumThreads(1)
+    shm, ring = _attach_ring(*ring_info)
+    height, width = ring.shape[1:3]
+    undistorter = config_undistorter(config, width, height)
+    undistort_rois = None
+    if config['undistort_rois_only'] and rois:
+        undistort_rois = [resolve_roi(roi, width, height) for roi in rois]
+    try:
+        while True:
+            task = tasks.get()
+            if task is STOP:
+                break
+            order, seq, timestamp, slot = task
+            # A frame that fails still returns its slot and its order number, or the collector would stall on it
+            try:
+                frame = ring[slot] if undistorter is None else undistorter.apply(ring[slot], undistort_rois)
+                _, measurement = measure_frame(frame, scale_range, edge_params, rois)
+            except Exception as error:
+                print(f"Frame {seq} could not be measured: {error!r}", file=sys.stderr)
+                measurement = None
+            free_slots.put(slot)
+            if measurement is not None:
+                measurement = {key: measurement[key] for key in ('height', 'top_y', 'bot_y', 'line_count')}
+            results.put((order, seq, timestamp, measurement))
+    finally:
+        results.put(STOP)
+        del ring
+        shm.close()
+
+def run_pipeline(config, workers, on_frame, on_stable):
+    """Run capture, a pool of measuring workers and an in-order collector.
+
+    on_frame(seq, timestamp, measurement) is called for every frame and
+    on_stable(seq, timestamp, height) for every stable height, both in frame order.
+    """
+    ctx = mp.get_context('spawn')
+    edge_params = dict(EDGE_PARAMS, **config['edge_params'])
+    scale_range = max(1, int(config['scale_range']))
+    slots = 2 * workers + 2
+
+    control, ring_queue, stats = ctx.Queue(), ctx.Queue(), ctx.Queue()
+    free_slots, tasks, results = ctx.Queue(), ctx.Queue(), ctx.Queue()
+    capture = ctx.Process(target=capture_process, name='capture', daemon=True,
+                          args=(config['source'], config['realtime'], control, ring_queue, free_slots, tasks, workers, stats))
+    capture.start()
+
+    first = child_message(control, capture)
+    if first is STOP:
+        capture.join()
+        print(f"Error: Could not read from source {config['source']}", file=sys.stderr)
+        return
+
+    # Shared-memory ring of frame slots, frames are never pickled
+    shape, dtype = first
+    shm = shared_memory.SharedMemory(create=True, size=slots * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    ring_info = (shm.name, slots, shape, dtype)
+    for slot in range(slots):
+        free_slots.put(slot)
+    ring_queue.put(ring_info[:2])
+
+    pool = [ctx.Process(target=worker_process, name=f'worker-{i}', daemon=True,
+                        args=(ring_info, free_slots, tasks, results, scale_range, edge_params, config['rois'], config))
+            for i in range(workers)]
+    for process in pool:
+        process.start()
+
+    # Collect results and hand them to the stabilizer in frame order
+    stabilizer = HeightStabilizer(config['stability_params'])
+    pending, next_order, running, processed = {}, 1, workers, 0
+    start = time.time()
+    try:
+        while running:
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in pool):
+                    print("Error: all workers exited", file=sys.stderr)
+                    break
+                continue
+            if result is STOP:
+                running -= 1
+                continue
+            pending[result[0]] = result
+            while next_order in pending:
+                _, seq, timestamp, measurement = pending.pop(next_order)
+                next_order += 1
+                processed += 1
+                on_frame(seq, timestamp, measurement)
+                if measurement is not None:
+                    stable_height = stabilizer.update(measurement['height'], timestamp)
+                    if stable_height is not None:
+                        on_stable(seq, timestamp, stable_height)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            capture_stats = stats.get(timeout=2.0)
+        except queue.Empty:
+            capture_stats = {'frames_captured': 0, 'frames_dropped': 0}
+        for process in [capture] + pool:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        shm.close()
+        shm.unlink()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"Processed {processed} frames with {workers} workers in {elapsed:.2f} s ({processed / elapsed:.1f} fps), "
+          f"captured {capture_stats['frames_captured']}, dropped {capture_stats['frames_dropped']}", file=sys.stderr)
@@ -0,0 +1,160 @@
+import collections
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Clip settings: frames kept before a trigger (the trigger frame included) and recorded after it,
+# finished clips waiting for the encoder (a clip is dropped when it is that far behind), codec and
+# container, frame rate when the timestamps give none, and the [low, high] height range in cm outside
+# of which a measurement triggers a clip (None: only stable heights trigger)
+RECORDER_PARAMS = {'PRE_FRAMES': 60, 'POST_FRAMES': 60, 'MAX_QUEUED_CLIPS': 2, 'FOURCC': 'MJPG',
+                   'EXTENSION': '.avi', 'FPS': 30.0, 'TOLERANCE': None}
+
+class Clip:
+    """Frames and per-frame records around a trigger, filled by the frame loop and written by the encoder"""
+
+    def __init__(self, reason, record, entries, post_frames):
+        self.triggers = [{'reason': reason, 'seq': record['seq'], 'timestamp': record['timestamp']}]
+        self.entries, self.remaining, self.created = entries, post_frames, time.time()
+
+class ClipRecorder:
+    """Keeps the last raw frames in memory and writes clips around stable heights or out-of-tolerance frames.
+
+    add() is called for every frame: it copies the frame into a recycled buffer of the ring, so there is no
+    allocation once the buffers exist. On a trigger the ring's buffers move to a new clip without copying,
+    the next POST_FRAMES frames are added to it and the finished clip goes to a background encoder thread
+    that writes <name>.avi and <name>.jsonl (the frame records) and hands the buffers back.
+    """
+
+    def __init__(self, directory, params=None):
+        self.directory, self.params = directory, dict(RECORDER_PARAMS, **(params or {}))
+        os.makedirs(directory, exist_ok=True)
+        self.ring, self.clip, self.in_tolerance = collections.deque(), None, True
+        self.pool, self.pool_lock = [], threading.Lock()
+        self.clips = queue.Queue(self.params['MAX_QUEUED_CLIPS'])
+        self.clips_written = self.clips_dropped = self.frames_written = 0
+        self.encode_seconds = 0.0
+        self.thread = threading.Thread(target=self._encode_loop, name='clip-encoder', daemon=True)
+        self.thread.start()
+
+    def _buffer(self, frame):
+        with self.pool_lock:
+            while self.pool:
+                buffer = self.pool.pop()
+                if buffer.shape == frame.shape and buffer.dtype == frame.dtype:
+                    return buffer
+        return np.empty_like(frame)
+
+    def _recycle(self, entries):
+        with self.pool_lock:
+            self.pool.extend(buffer for buffer, _ in entries)
+
+    def trigger_reason(self, record, stable_height):
+        """'stable' for a stable height, 'tolerance' when the height leaves the tolerance range, else None"""
+        if stable_height is not None:
+            return 'stable'
+        height, tolerance = record.get('height'), self.params['TOLERANCE']
+        if tolerance is None or height is None:
+            return None
+        inside = tolerance[0] <= height <= tolerance[1]
+        left, self.in_tolerance = self.in_tolerance and not inside, inside
+        return 'tolerance' if left else None
+
+    def add(self, frame, record, stable_height=None):
+        """Keep one raw frame and its record, stable_height is the stable height announced on this frame"""
+        buffer = self._buffer(frame)
+        np.copyto(buffer, frame)
+        if stable_height is not None:
+            record = dict(record, stable_height=stable_height)
+        reason = self.trigger_reason(record, stable_height)
+
+        if self.clip is not None:
+            # Triggers while a clip is recording are noted in it
+            self.clip.entries.append((buffer, record))
+            if reason:
+                self.clip.triggers.append({'reason': reason, 'seq': record['seq'], 'timestamp': record['timestamp']})
+            self.clip.remaining -= 1
+            if self.clip.remaining <= 0:
+                self._finish()
+            return
+
+        self.ring.append((buffer, record))
+        if len(self.ring) > self.params['PRE_FRAMES']:
+            self._recycle([self.ring.popleft()])
+        if reason:
+            self.clip = Clip(reason, record, list(self.ring), self.params['POST_FRAMES'])
+            self.ring.clear()
+            if self.clip.remaining <= 0:
+                self._finish()
+
+    def _finish(self, block=False):
+        clip, self.clip = self.clip, None
+        try:
+            self.clips.put(clip, block=block)
+        except queue.Full:
+            # Never wait for the encoder in the frame loop
+            self.clips_dropped += 1
+            self._recycle(clip.entries)
+            print(f"Clip at frame {clip.triggers[0]['seq']} dropped, the encoder is behind", file=sys.stderr)
+
+    def _encode_loop(self):
+        while True:
+            clip = self.clips.get()
+            if clip is None:
+                break
+            start = time.perf_counter()
+            try:
+                self.write_clip(clip)
+            except (OSError, cv2.error) as error:
+                print(f"Could not write clip: {error}", file=sys.stderr)
+            finally:
+                self._recycle(clip.entries)
+            self.encode_seconds += time.perf_counter() - start
+
+    def write_clip(self, clip):
+        """Write the clip's frames as a video and its records as JSON lines, both named after the first trigger"""
+        trigger = clip.triggers[0]
+        name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(clip.created))}-{trigger['seq']}-{trigger['reason']}"
+        frames = [buffer for buffer, _ in clip.entries]
+        records = [record for _, record in clip.entries]
+
+        # Frame rate of the recording from the frame timestamps
+        steps = np.diff([record['timestamp'] for record in records])
+        steps = steps[steps > 0]
+        fps = 1.0 / float(np.median(steps)) if len(steps) else self.params['FPS']
+
+        video_name = name + self.params['EXTENSION']
+        height, width = frames[0].shape[:2]
+        writer = cv2.VideoWriter(os.path.join(self.directory, video_name), cv2.VideoWriter_fourcc(*self.params['FOURCC']),
+                                 fps, (width, height), frames[0].ndim == 3)
+        if not writer.isOpened():
+            raise OSError(f"no video writer for {video_name}")
+        for frame in frames:
+            writer.write(frame)
+        writer.release()
+
+        with open(os.path.join(self.directory, name + '.jsonl'), 'w') as f:
+            f.write(json.dumps({'type': 'clip', 'video': video_name, 'frames': len(frames), 'fps': fps,
+                                'triggers': clip.triggers}) + "\n")
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        self.clips_written += 1
+        self.frames_written += len(frames)
+
+    def summary(self):
+        return (f"Clips: {self.clips_written} written ({self.frames_written} frames, "
+                f"{self.encode_seconds:.2f} s encoding), {self.clips_dropped} dropped")
+
+    def close(self):
+        """Write the clip still recording (cut short) and whatever is queued, then stop the encoder"""
+        if self.clip is not None:
+            self._finish(block=True)
+        self.clips.put(None)
+        self.thread.join()
+        print(self.summary(), file=sys.stderr)
@@ -0,0 +1,341 @@
+import asyncio
+import collections
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+from measurement_log import MeasurementLogWriter
+
+# Sink settings: records waiting per sink, what to do when a sink falls that far behind
+# ('drop_oldest', 'block' the frame loop, or 'coalesce' pending frame records of the same camera into the newest),
+# most records written per batch, seconds before reconnecting a failed socket and waiting for the sinks on close
+SINK_PARAMS = {'QUEUE_SIZE': 256, 'POLICY': 'drop_oldest', 'BATCH': 64, 'RETRY_INTERVAL': 1.0, 'CLOSE_TIMEOUT': 5.0}
+
+POLICIES = ('drop_oldest', 'block', 'coalesce')
+
+# Largest UDP payload, batches are split into datagrams of whole JSON lines below it
+MAX_DATAGRAM = 60000
+
+def encode_lines(records):
+    """JSON lines of a batch of records as bytes"""
+    return ''.join(json.dumps(record) + "\n" for record in records).encode()
+
+class SinkQueue:
+    """Bounded thread-safe queue between the frame loop and one sink's asyncio task"""
+
+    def __init__(self, size, policy, wake):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown sink policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        self.size, self.policy, self.wake = size, policy, wake
+        self.entries, self.pending_frames, self.closed = collections.deque(), {}, False
+        self.condition = threading.Condition()
+        self.dropped = self.coalesced = 0
+        self.blocked_seconds = 0.0
+
+    def put(self, published, record):
+        with self.condition:
+            if self.closed:
+                return
+            # A newer frame record of the same camera replaces the one still waiting, in its place
+            key = record.get('camera')
+            if self.policy == 'coalesce' and record.get('type') == 'frame' and key in self.pending_frames:
+                self.pending_frames[key][:] = [published, record, key]
+                self.coalesced += 1
+                return
+            if self.policy == 'block':
+                start = time.perf_counter()
+                while len(self.entries) >= self.size and not self.closed:
+                    self.condition.wait(0.1)
+                self.blocked_seconds += time.perf_counter() - start
+            while len(self.entries) >= self.size:
+                self._forget(self.entries.popleft())
+                self.dropped += 1
+            entry = [published, record, key]
+            self.entries.append(entry)
+            if self.policy == 'coalesce' and record.get('type') == 'frame':
+                self.pending_frames[key] = entry
+        self.wake()
+
+    def _forget(self, entry):
+        if self.pending_frames.get(entry[2]) is entry:
+            del self.pending_frames[entry[2]]
+
+    def take(self, count):
+        """Remove and return up to count (published, record) entries"""
+        with self.condition:
+            batch = []
+            while self.entries and len(batch) < count:
+                entry = self.entries.popleft()
+                self._forget(entry)
+                batch.append((entry[0], entry[1]))
+            if batch:
+                self.condition.notify_all()
+            return batch
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.wake()
+
+class Sink:
+    """One output: an asyncio task that takes batches from its queue and sends them, with counters"""
+
+    def __init__(self, name, params):
+        self.name, self.params = name, params
+        self.queue, self.event, self.failing = None, None, False
+        self.published = self.sent = self.failed = self.errors = self.batches = 0
+        self.latency_sum = self.latency_max = 0.0
+
+    async def send(self, records):
+        raise NotImplementedError
+
+    async def reset(self):
+        """Drop the connection after a failure, the next batch reconnects"""
+
+    async def aclose(self):
+        await self.reset()
+
+    def _wake(self):
+        if self.event is not None:
+            self.event.set()
+
+    async def run(self):
+        self.event = asyncio.Event()
+        while True:
+            batch = self.queue.take(self.params['BATCH'])
+            if not batch:
+                if self.queue.closed:
+                    break
+                await self.event.wait()
+                self.event.clear()
+                continue
+            try:
+                await self.send([record for _, record in batch])
+            except (OSError, asyncio.IncompleteReadError, ConnectionError) as error:
+                self.errors += 1
+                self.failed += len(batch)
+                # Report a dead sink once, not on every retry
+                if not self.failing:
+                    print(f"Sink {self.name}: {error}, retrying every {self.params['RETRY_INTERVAL']} s", file=sys.stderr)
+                self.failing = True
+                await self.reset()
+                if not self.queue.closed:
+                    await asyncio.sleep(self.params['RETRY_INTERVAL'])
+                continue
+            now = time.time()
+            self.failing = False
+            self.sent += len(batch)
+            self.batches += 1
+            for published, _ in batch:
+                self.latency_sum += now - published
+                self.latency_max = max(self.latency_max, now - published)
+        await self.aclose()
+
+    def summary(self):
+        queue = self.queue
+        text = (f"Sink {self.name}: {self.sent} of {self.published} records sent in {self.batches} batches, "
+                f"latency {1000 * self.latency_sum / max(self.sent, 1):.1f} ms mean / {1000 * self.latency_max:.1f} ms max, "
+                f"{queue.dropped} dropped, {queue.coalesced} coalesced, {self.failed} failed in {self.errors} errors")
+        if queue.policy == 'block':
+            text += f", frame loop blocked {queue.blocked_seconds:.2f} s"
+        return text
+
+class FileSink(Sink):
+    """Append JSON lines to a file ('-' for stdout), writes run in a thread so the other sinks keep going"""
+
+    def __init__(self, path, params):
+        super().__init__(path, params)
+        self.path, self.file = path, None
+
+    async def send(self, records):
+        data = encode_lines(records).decode()
+        await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+
+    def _write(self, data):
+        if self.file is None:
+            self.file = sys.stdout if self.path == '-' else open(self.path, 'a')
+        self.file.write(data)
+        self.file.flush()
+
+    async def aclose(self):
+        if self.file is not None and self.file is not sys.stdout:
+            self.file.close()
+
+class LogSink(Sink):
+    """Append records to a binary measurement log directory (see measurement_log.py), in a thread"""
+
+    def __init__(self, path, params):
+        super().__init__(f"log:{path}", params)
+        self.path, self.writer = path, None
+
+    async def send(self, records):
+        await asyncio.get_event_loop().run_in_executor(None, self._append, records)
+
+    def _append(self, records):
+        if self.writer is None:
+            self.writer = MeasurementLogWriter(self.path)
+        for record in records:
+            self.writer.append(record)
+
+    async def aclose(self):
+        if self.writer is not None:
+            await asyncio.get_event_loop().run_in_executor(None, self.writer.close)
+
+class UdpSink(Sink):
+    """Send JSON lines as UDP datagrams, as many whole lines per datagram as fit"""
+
+    def __init__(self, name, host, port, params):
+        super().__init__(name, params)
+        self.address, self.transport = (host, port), None
+
+    async def send(self, records):
+        if self.transport is None:
+            self.transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=self.address)
+        datagram = b''
+        for record in records:
+            line = encode_lines([record])
+            if datagram and len(datagram) + len(line) > MAX_DATAGRAM:
+                self.transport.sendto(datagram)
+                datagram = b''
+            datagram += line
+        self.transport.sendto(datagram)
+
+    async def reset(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+class StreamSink(Sink):
+    """Write JSON lines to a TCP or Unix stream socket, waiting for the socket buffer on slow readers"""
+
+    def __init__(self, name, connect, params):
+        super().__init__(name, params)
+        self.connect, self.reader, self.writer = connect, None, None
+
+    async def send(self, records):
+        if self.writer is None:
+            self.reader, self.writer = await self.connect()
+        self.writer.write(self.encode(records))
+        await self.writer.drain()
+        await self.replies(len(records))
+
+    def encode(self, records):
+        return encode_lines(records)
+
+    async def replies(self, count):
+        pass
+
+    async def reset(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+class RedisSink(StreamSink):
+    """PUBLISH every record as JSON on a channel of a local Redis broker (plain RESP, no client library)"""
+
+    def __init__(self, name, host, port, channel, params):
+        super().__init__(name, lambda: asyncio.open_connection(host, port), params)
+        self.channel = channel.encode()
+
+    def encode(self, records):
+        commands = []
+        for record in records:
+            message = json.dumps(record).encode()
+            commands.append(b'*3\r\n$7\r\nPUBLISH\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n'
+                            % (len(self.channel), self.channel, len(message), message))
+        return b''.join(commands)
+
+    async def replies(self, count):
+        # One integer reply (subscriber count) per PUBLISH, an error reply means the broker refused it
+        for _ in range(count):
+            reply = await self.reader.readline()
+            if not reply:
+                raise ConnectionError("broker closed the connection")
+            if reply.startswith(b'-'):
+                raise ConnectionError(reply[1:].strip().decode())
+
+def make_sink(spec, params):
+    """Sink for a spec: a path or '-' (file), log:dir (binary log), udp://host:port, tcp://host:port, unix:///path
+    or redis://host:port/channel"""
+    if isinstance(spec, dict):
+        params = dict(params, **{key.upper(): value for key, value in spec.items() if key != 'url'})
+        spec = spec['url']
+    url = urlparse(spec)
+    if url.scheme == 'udp':
+        sink = UdpSink(spec, url.hostname, url.port, params)
+    elif url.scheme == 'tcp':
+        sink = StreamSink(spec, lambda: asyncio.open_connection(url.hostname, url.port), params)
+    elif url.scheme == 'unix':
+        sink = StreamSink(spec, lambda: asyncio.open_unix_connection(url.path), params)
+    elif url.scheme == 'log':
+        sink = LogSink(spec[len('log:'):], params)
+    elif url.scheme == 'redis':
+        sink = RedisSink(spec, url.hostname or '127.0.0.1', url.port or 6379, url.path.strip('/') or 'heights', params)
+    else:
+        sink = FileSink(url.path if url.scheme == 'file' else spec, params)
+    sink.queue = SinkQueue(params['QUEUE_SIZE'], params['POLICY'], lambda: None)
+    return sink
+
+class SinkHub:
+    """Fans measurement records out to several sinks served by an asyncio loop in a background thread.
+
+    publish() only puts the record in each sink's bounded queue, so a slow or dead sink never stalls
+    the frame loop (unless its policy is 'block'). close() sends what is still queued and stops the loop.
+    """
+
+    def __init__(self, specs, params=None):
+        params = dict(SINK_PARAMS, **(params or {}))
+        self.close_timeout = params['CLOSE_TIMEOUT']
+        self.loop = asyncio.new_event_loop()
+        self.sinks = [make_sink(spec, params) for spec in specs]
+        for sink in self.sinks:
+            sink.queue.wake = self._waker(sink)
+        self.thread = threading.Thread(target=self._run, name='sinks', daemon=True)
+        self.thread.start()
+
+    def _waker(self, sink):
+        def wake():
+            try:
+                self.loop.call_soon_threadsafe(sink._wake)
+            except RuntimeError:
+                pass  # Loop already closed
+        return wake
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(asyncio.gather(*(sink.run() for sink in self.sinks), return_exceptions=True))
+        finally:
+            self.loop.close()
+
+    def publish(self, record):
+        published = time.time()
+        for sink in self.sinks:
+            sink.published += 1
+            sink.queue.put(published, record)
+
+    def summary(self):
+        return "\n".join(sink.summary() for sink in self.sinks)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.queue.close()
+        self.thread.join(self.close_timeout)
+        print(self.summary(), file=sys.stderr)
+
+def open_output(config, headless=True):
+    """Where measurement records go: the headless output file (or stdout), or a SinkHub when sinks are configured"""
+    if not config['sinks']:
+        if not headless:
+            return None
+        return sys.stdout if config['output'] == '-' else open(config['output'], 'a')
+    return SinkHub(([config['output']] if headless else []) + list(config['sinks']), config['sink_params'])
+
+def close_output(out):
+    """Close what open_output returned (stdout stays open)"""
+    if out is not None and out is not sys.stdout:
+        out.close()
@@ -0,0 +1,135 @@
+import glob
+import os
+import sys
+import time
+
+import cv2
+
+from capture import LatestFrameCapture
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# All sources share one interface: read() -> (ret, frame, seq, timestamp), release(),
+# plus 'live', 'frames_captured' and 'frames_dropped'.
+
+class CameraSource:
+    """Live camera read on a background thread, the newest frame wins"""
+    live = True
+
+    def __init__(self, index):
+        self.cap = cv2.VideoCapture(index)
+        self.grabber = None
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self, timeout=None):
+        if self.grabber is None:
+            # Keep the driver queue short so processing always sees the newest frame
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            self.grabber = LatestFrameCapture(self.cap).start()
+        return self.grabber.read(timeout)
+
+    @property
+    def frames_captured(self):
+        return self.grabber.frames_captured if self.grabber else 0
+
+    @property
+    def frames_dropped(self):
+        return self.grabber.frames_dropped if self.grabber else 0
+
+    def release(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+        self.cap.release()
+
+class _ReplaySource:
+    """Shared pacing for recorded sources: max speed by default, or real-time by frame timestamps"""
+    live = False
+    frames_dropped = 0
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.frames_captured = 0
+        self._first_timestamp, self._start_wall = None, None
+
+    def _pace(self, timestamp):
+        if not self.realtime:
+            return
+        if self._first_timestamp is None:
+            self._first_timestamp, self._start_wall = timestamp, time.time()
+            return
+        delay = self._start_wall + (timestamp - self._first_timestamp) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self, timeout=None):
+        ret, frame, timestamp = self._next_frame()
+        if not ret:
+            return False, None, self.frames_captured, 0.0
+        self._pace(timestamp)
+        self.frames_captured += 1
+        return True, frame, self.frames_captured, timestamp
+
+class VideoFileSource(_ReplaySource):
+    """Recorded video file, timestamps come from the container"""
+
+    def __init__(self, path, realtime=False):
+        super().__init__(realtime)
+        self.cap = cv2.VideoCapture(path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self._buffer = None
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def _next_frame(self):
+        ret, frame = self.cap.read(self._buffer)
+        if not ret:
+            return False, None, 0.0
+        self._buffer = frame
+        timestamp = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if timestamp <= 0 and self.frames_captured > 0:
+            timestamp = self.frames_captured / self.fps
+        return True, frame, timestamp
+
+    def release(self):
+        self.cap.release()
+
+class ImageSequenceSource(_ReplaySource):
+    """Directory or glob of still images replayed in sorted order at a nominal fps"""
+
+    def __init__(self, pattern, fps=30.0, realtime=False):
+        super().__init__(realtime)
+        if os.path.isdir(pattern):
+            self.paths = sorted(os.path.join(pattern, name) for name in os.listdir(pattern)
+                                if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            self.paths = sorted(glob.glob(pattern))
+        self.fps = fps
+        self._index = 0
+
+    def isOpened(self):
+        return len(self.paths) > 0
+
+    def _next_frame(self):
+        while self._index < len(self.paths):
+            path = self.paths[self._index]
+            self._index += 1
+            frame = cv2.imread(path)
+            if frame is not None:
+                return True, frame, (self._index - 1) / self.fps
+            print(f"Could not read image: {path}", file=sys.stderr)
+        return False, None, 0.0
+
+    def release(self):
+        pass
+
+def open_source(spec, realtime=False, fps=30.0):
+    """Open a camera index, video file, image directory or image glob as a frame source"""
+    if isinstance(spec, int) or str(spec).isdigit():
+        return CameraSource(int(spec))
+    spec = str(spec)
+    if os.path.isdir(spec) or any(c in spec for c in '*?['):
+        return ImageSequenceSource(spec, fps=fps, realtime=realtime)
+    return VideoFileSource(spec, realtime=realtime)
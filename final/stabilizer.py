@@ -0,0 +1,177 @@
+import bisect
+import collections
+
+# Stabilization settings: frames to average, allowed deviation (cm), seconds a stable height is held.
+# MIN_HISTORY frames (default HISTORY_LENGTH) are needed before a height can be announced.
+# OUTLIER_MAD > 0 drops readings further than that many (scaled) MADs from the median, OUTLIER_PATIENCE
+# outliers in a row are taken as a new object. KALMAN smooths readings with a 1-D constant-height filter.
+STABILITY_PARAMS = {'HISTORY_LENGTH': 10, 'THRESHOLD': 0.2, 'DISPLAY_TIME': 3, 'MIN_HISTORY': None,
+                    'OUTLIER_MAD': 0, 'OUTLIER_PATIENCE': 3,
+                    'KALMAN': False, 'PROCESS_NOISE': 0.01, 'MEASUREMENT_NOISE': 0.25}
+
+# Scales the MAD to the standard deviation of normally distributed readings
+MAD_TO_STD = 1.4826
+
+class RunningWindow:
+    """Ring of the last `size` values with running sum, sum of squares and sliding min/max.
+
+    push() costs amortized O(1), plus O(size) (bisect insert and delete in a list) when keep_sorted keeps
+    the sorted copy that median and mad() need.
+    """
+
+    def __init__(self, size, keep_sorted=False):
+        self.size, self.keep_sorted = max(1, int(size)), keep_sorted
+        self.clear()
+
+    def clear(self):
+        self.values, self.sorted = [0.0] * self.size, []
+        self.count, self.index, self.position = 0, 0, 0
+        self.total = self.squares = 0.0
+        # Monotonic (position, value) queues, the front is the current min / max
+        self.low, self.high = collections.deque(), collections.deque()
+
+    def push(self, value):
+        """Add a value, evicting the oldest one once the ring is full"""
+        if self.count == self.size:
+            old = self.values[self.index]
+            self.total -= old
+            self.squares -= old * old
+            if self.keep_sorted:
+                del self.sorted[bisect.bisect_left(self.sorted, old)]
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.total += value
+        self.squares += value * value
+        if self.keep_sorted:
+            bisect.insort(self.sorted, value)
+
+        while self.low and self.low[-1][1] >= value:
+            self.low.pop()
+        while self.high and self.high[-1][1] <= value:
+            self.high.pop()
+        self.low.append((self.position, value))
+        self.high.append((self.position, value))
+        for queue in (self.low, self.high):
+            if queue[0][0] <= self.position - self.size:
+                queue.popleft()
+        self.position += 1
+
+        # Re-sum once per lap so rounding errors of the running sums cannot build up
+        self.index = (self.index + 1) % self.size
+        if self.index == 0:
+            self.total, self.squares = sum(self.values), sum(v * v for v in self.values)
+
+    def ordered(self):
+        """Values from oldest to newest"""
+        if self.count < self.size:
+            return self.values[:self.count]
+        return self.values[self.index:] + self.values[:self.index]
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def variance(self):
+        return max(self.squares / self.count - self.mean ** 2, 0.0)
+
+    @property
+    def min(self):
+        return self.low[0][1]
+
+    @property
+    def max(self):
+        return self.high[0][1]
+
+    @property
+    def median(self):
+        middle = self.count // 2
+        return self.sorted[middle] if self.count % 2 else (self.sorted[middle - 1] + self.sorted[middle]) / 2
+
+    def mad(self, median):
+        """Upper median of the absolute deviations from median, in O(size) without sorting them.
+
+        The deviations of the sorted values below and above the median are two sorted runs,
+        merged from the median outwards until the middle one is reached.
+        """
+        values = self.sorted
+        below = bisect.bisect_left(values, median) - 1
+        above = below + 1
+        for _ in range(self.count // 2 + 1):
+            if above >= len(values) or (below >= 0 and median - values[below] <= values[above] - median):
+                deviation, below = median - values[below], below - 1
+            else:
+                deviation, above = values[above] - median, above + 1
+        return deviation
+
+class HeightStabilizer:
+    """Height history of one camera that announces a stable height once the readings settle"""
+
+    def __init__(self, params=None):
+        self.params = dict(STABILITY_PARAMS, **(params or {}))
+        # The sorted copy is only needed (and paid for) with outlier rejection
+        self.window = RunningWindow(self.params['HISTORY_LENGTH'], keep_sorted=bool(self.params['OUTLIER_MAD']))
+        self.reset()
+
+    def reset(self):
+        """Forget the history and the current stable height"""
+        self.window.clear()
+        self.stable_height, self.last_stable_time = None, None
+        self.estimate, self.estimate_variance, self.rejected = None, None, 0
+
+    @property
+    def history(self):
+        return self.window.ordered()
+
+    @property
+    def std(self):
+        """Standard deviation of the current window, None while it is empty"""
+        return self.window.variance ** 0.5 if self.window.count else None
+
+    def is_outlier(self, value):
+        """True when the value is further from the window median than OUTLIER_MAD scaled MADs (at least THRESHOLD),
+        O(HISTORY_LENGTH) per reading"""
+        median = self.window.median
+        mad = self.window.mad(median) * MAD_TO_STD
+        return abs(value - median) > max(self.params['OUTLIER_MAD'] * mad, self.params['THRESHOLD'])
+
+    def smooth(self, value):
+        """One predict/update step of a 1-D Kalman filter with a constant height model"""
+        if self.estimate is None:
+            self.estimate, self.estimate_variance = value, self.params['MEASUREMENT_NOISE']
+            return value
+        variance = self.estimate_variance + self.params['PROCESS_NOISE']
+        gain = variance / (variance + self.params['MEASUREMENT_NOISE'])
+        self.estimate += gain * (value - self.estimate)
+        self.estimate_variance = (1 - gain) * variance
+        return self.estimate
+
+    def is_stable(self):
+        """Enough readings and every one of them within THRESHOLD of the window mean"""
+        window, threshold = self.window, self.params['THRESHOLD']
+        if window.count < (self.params['MIN_HISTORY'] or self.params['HISTORY_LENGTH']):
+            return False
+        mean = window.mean
+        return window.max - mean < threshold and mean - window.min < threshold
+
+    def update(self, current_height, frame_time):
+        """Add a measurement and return the new stable height when one is announced, otherwise None"""
+        if self.params['OUTLIER_MAD'] and self.window.count >= 3 and self.is_outlier(current_height):
+            self.rejected += 1
+            if self.rejected < self.params['OUTLIER_PATIENCE']:
+                return None
+            # A run of outliers is a new object rather than noise
+            self.window.clear()
+            self.estimate = None
+        self.rejected = 0
+        self.window.push(self.smooth(current_height) if self.params['KALMAN'] else current_height)
+
+        # Frame timestamps instead of wall time, so replays at any speed behave like the live camera
+        if self.last_stable_time is not None and frame_time - self.last_stable_time <= self.params['DISPLAY_TIME']:
+            return None
+        if not self.is_stable():
+            return None
+        self.stable_height = self.window.mean
+        self.last_stable_time = frame_time
+        return self.stable_height
@@ -0,0 +1,309 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing as mp
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmark import load_frames, print_table, time_ms
+from config import load_config, merge_config
+from detection import (EDGE_PARAMS, EDGE_STAGES, LINE_DTYPE, scale_geometry, resolve_roi, find_horizontal_lines,
+                       shift_lines, refine_subpixel, measure_lines)
+from sources import open_source
+
+# Values tried for each swept EDGE_PARAMS key (replaced key by key with --space)
+SEARCH_SPACE = {'PREPROCESS': ['bilateral', 'half_bilateral', 'gaussian'],
+                'ADAPTIVE_BLOCK_SIZE': [7, 11, 15, 21],
+                'MORPH_KERNEL': [(15, 1), (25, 1), (41, 1)],
+                'CANNY_THRESHOLDS': [(30, 150), (50, 150), (80, 200)],
+                'HOUGH_THRESHOLD': [20, 30, 50],
+                'MIN_LINE_LENGTH': [60, 100, 160],
+                'MAX_LINE_GAP': [10, 20, 40]}
+
+# Tuning settings: error (cm) charged for a frame without a measurement, smallest error difference (cm) that
+# counts as more accurate, memory per worker for cached stage outputs (MB) and most configurations per refinement round
+TUNE_PARAMS = {'MISS_PENALTY': 5.0, 'ERROR_RESOLUTION': 0.01, 'CACHE_MB': 256, 'ROUND_SIZE': 32}
+
+# Keys the edge stages depend on, configurations that share them share their edge maps
+EDGE_KEYS = [key for _, keys, _ in EDGE_STAGES for key in keys]
+
+def load_labels(path, config, max_frames, step):
+    """Labelled recordings from a JSON file: a list of {"source", "height" (cm)} with optional
+    "scale_range", "rois", "max_frames" and "step" (the config and command line give the defaults)"""
+    with open(path) as f:
+        labels = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for label in labels:
+        if 'source' not in label or 'height' not in label:
+            raise ValueError(f"{path}: every recording needs 'source' and 'height', got {label}")
+        source = label['source']
+        if isinstance(source, str) and not source.isdigit() and not os.path.isabs(source):
+            label['source'] = os.path.join(base, source)
+        label.setdefault('scale_range', config['scale_range'])
+        label.setdefault('rois', config['rois'])
+        label.setdefault('max_frames', max_frames)
+        label.setdefault('step', step)
+        # Checked here, a worker that cannot load its frames would be restarted by the pool forever
+        capture = open_source(label['source'])
+        opened = capture.isOpened()
+        capture.release()
+        if not opened:
+            raise ValueError(f"{path}: could not open source {label['source']}")
+    return labels
+
+def load_space(path):
+    """SEARCH_SPACE with the keys of a JSON file ({key: [values]}) replaced, lists of pairs become tuples"""
+    space = dict(SEARCH_SPACE)
+    if path:
+        with open(path) as f:
+            for key, values in json.load(f).items():
+                if key not in EDGE_PARAMS:
+                    raise ValueError(f"{key} is not an EDGE_PARAMS key")
+                space[key] = values
+    return {key: [tuple(value) if isinstance(value, list) else value for value in values] for key, values in space.items()}
+
+class StageCache:
+    """Least recently used stage outputs of one worker, bounded by their size in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes, self.bytes, self.entries = max_bytes, 0, collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, compute):
+        """(output, milliseconds it took) of compute(), computed only when key is not cached"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        entry = time_ms(compute)
+        self.entries[key] = entry
+        self.bytes += entry[0].nbytes
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (old, _) = self.entries.popitem(last=False)
+            self.bytes -= old.nbytes
+        return entry
+
+# Per worker: the labelled frames as (label, frame, [(x0, y0, crop)]) and the stage cache
+_frames, _cache = [], None
+
+def init_worker(labels, cache_mb):
+    """Load every labelled recording into the worker once"""
+    global _cache
+    cv2.setNumThreads(1)
+    _cache = StageCache(cache_mb * 1024 * 1024)
+    for label in labels:
+        frames = load_frames(label['source'], label['max_frames'] * label['step'])[::label['step']]
+        if not frames:
+            continue
+        height, width = frames[0].shape[:2]
+        label = dict(label, geometry=scale_geometry(width, height, max(1, int(label['scale_range']))))
+        rois = [resolve_roi(roi, width, height) for roi in label['rois']] or [(0, 0, width, height)]
+        for frame in frames:
+            crops = [(x0, y0, frame[y0:y1, x0:x1]) for x0, y0, x1, y1 in rois if x1 - x0 >= 2 and y1 - y0 >= 2]
+            _frames.append((label, frame, crops))
+
+def staged_edges(key, crop, params):
+    """Edge map of a crop and the milliseconds of its stages; stage outputs are cached under the parameter values
+    of that stage and the ones before it (a cached stage still counts the time it took), except the edge map itself
+    which only the configurations of one group use"""
+    image, total_ms = crop, 0.0
+    for index, (name, keys, stage) in enumerate(EDGE_STAGES):
+        key = key + (name,) + tuple(params[k] for k in keys)
+        if index < len(EDGE_STAGES) - 1:
+            image, ms = _cache.get(key, lambda image=image: stage(image, params))
+        else:
+            image, ms = time_ms(stage, image, params)
+        total_ms += ms
+    return image, total_ms
+
+def summarize(errors, frame_ms, miss_penalty):
+    """Accuracy and mean per-frame cost of one configuration, errors holds None for frames without a measurement"""
+    found = [error for error in errors if error is not None]
+    return {'error': float(np.mean([miss_penalty if error is None else error for error in errors])),
+            'mae': float(np.mean(found)) if found else float('nan'),
+            'p95': float(np.percentile(found, 95)) if found else float('nan'),
+            'detected': len(found) / max(len(errors), 1), 'frame_ms': float(np.mean(frame_ms))}
+
+def evaluate_group(task):
+    """Evaluate configurations that share their edge stages over all labelled frames, computing each
+    frame's edge maps once for all of them"""
+    configs, miss_penalty = task
+    hits, misses = _cache.hits, _cache.misses
+    errors, frame_ms = [[] for _ in configs], [[] for _ in configs]
+    for frame_index, (label, frame, crops) in enumerate(_frames):
+        edge_maps = [staged_edges((frame_index, crop_index), crop, configs[0]) for crop_index, (_, _, crop) in enumerate(crops)]
+        _, scale_y_bottom, pixels_per_cm = label['geometry']
+        for index, params in enumerate(configs):
+            ms, lines = 0.0, [np.empty(0, LINE_DTYPE)]
+            for (x0, y0, _), (edges, edge_ms) in zip(crops, edge_maps):
+                found, hough_ms = time_ms(find_horizontal_lines, edges, params)
+                ms += edge_ms + hough_ms
+                lines.append(shift_lines(found, x0, y0))
+            lines = np.concatenate(lines)
+            lines = lines[np.argsort(lines['y_fine'], kind='stable')]
+            if params['SUBPIXEL']:
+                lines, subpixel_ms = time_ms(refine_subpixel, frame, lines, params)
+                ms += subpixel_ms
+            measurement = measure_lines(lines, scale_y_bottom, pixels_per_cm)
+            frame_ms[index].append(ms)
+            errors[index].append(None if measurement is None else abs(measurement['height'] - label['height']))
+    results = [(params, summarize(errors[i], frame_ms[i], miss_penalty)) for i, params in enumerate(configs)]
+    return results, (_cache.hits - hits, _cache.misses - misses)
+
+def grid_configs(space):
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+
+def random_configs(space, count, rng, seen):
+    """Up to count distinct configurations drawn uniformly from the grid, none of them in seen"""
+    total = int(np.prod([len(values) for values in space.values()]))
+    configs = []
+    while len(configs) < count and len(seen) < total:
+        config = {key: rng.choice(values) for key, values in space.items()}
+        if config_key(config) not in seen:
+            seen.add(config_key(config))
+            configs.append(config)
+    return configs
+
+def neighbours(config, space):
+    """Configurations one step away: a single swept key moved to the next smaller or larger value"""
+    found = []
+    for key, values in space.items():
+        if config[key] not in values:
+            continue
+        index = values.index(config[key])
+        for other in (index - 1, index + 1):
+            if 0 <= other < len(values):
+                found.append(dict(config, **{key: values[other]}))
+    return found
+
+def config_key(config):
+    return tuple(sorted(config.items()))
+
+def pareto_front(rows, resolution=TUNE_PARAMS['ERROR_RESOLUTION']):
+    """Rows no other row beats on both error and frame_ms, cheapest first (errors within resolution count as equal)"""
+    front, best_error = [], float('inf')
+    for row in sorted(rows, key=lambda row: (row['frame_ms'], row['error'])):
+        if row['error'] <= best_error - resolution:
+            front.append(row)
+            best_error = row['error']
+    return front
+
+class Tuner:
+    """Evaluates batches of swept configurations in a process pool and keeps every result"""
+
+    def __init__(self, pool, workers, base_params, miss_penalty):
+        self.pool, self.workers, self.base_params, self.miss_penalty = pool, workers, base_params, miss_penalty
+        self.rows, self.hits, self.misses = [], 0, 0
+
+    def run(self, configs, prefix=''):
+        """Evaluate the configurations not evaluated yet and return their result rows"""
+        configs = [config for config in configs if config_key(config) not in {row['key'] for row in self.rows}]
+        # One task per set of edge stage parameters, in order, with neighbouring tasks handed to the same worker
+        groups = collections.defaultdict(list)
+        for config in configs:
+            groups[tuple(config.get(key, self.base_params[key]) for key in EDGE_KEYS)].append(config)
+        tasks = [([dict(self.base_params, **config) for config in groups[key]], self.miss_penalty)
+                 for key in sorted(groups, key=repr)]
+        chunksize = max(1, len(tasks) // (4 * self.workers))
+        rows, start = [], time.perf_counter()
+        for results, (hits, misses) in self.pool.imap(evaluate_group, tasks, chunksize):
+            for params, result in results:
+                swept = {key: params[key] for key in configs[0]}
+                rows.append(dict(result, params=swept, key=config_key(swept)))
+            self.hits, self.misses = self.hits + hits, self.misses + misses
+            print(f"\r{prefix}{len(rows)}/{len(configs)} configurations, {time.perf_counter() - start:.0f} s",
+                  end='', file=sys.stderr)
+        if configs:
+            print(file=sys.stderr)
+        self.rows.extend(rows)
+        return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune EDGE_PARAMS against recordings with known heights')
+    parser.add_argument('labels', type=str, help='JSON list of {"source", "height" (cm)} recordings, optionally with "scale_range", "rois", "max_frames", "step"')
+    parser.add_argument('--config', type=str, help='Path to a JSON config file (its edge_params are the starting point)')
+    parser.add_argument('--space', type=str, help='JSON file of {EDGE_PARAMS key: [values]} replacing the default search space per key')
+    parser.add_argument('--search', choices=['grid', 'random', 'refine'], default='refine',
+                        help='Every combination, random samples, or random samples refined around the Pareto front')
+    parser.add_argument('--samples', type=int, default=64, help='Random configurations (random and refine)')
+    parser.add_argument('--rounds', type=int, default=4, help='Refinement rounds')
+    parser.add_argument('--workers', type=int, help='Evaluating processes (default: CPU count)')
+    parser.add_argument('--max-frames', type=int, default=100, help='Frames used per recording')
+    parser.add_argument('--step', type=int, default=3, help='Use every n-th frame of a recording')
+    parser.add_argument('--budget-ms', type=float, help='Pick the most accurate front configuration within this per-frame cost')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--output', type=str, default='tuned.json', help='Config file written with the picked edge_params')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    space = load_space(args.space)
+    labels = load_labels(args.labels, config, args.max_frames, args.step)
+    base_params = dict(EDGE_PARAMS, **config['edge_params'])
+    base_params = {key: tuple(value) if isinstance(value, list) else value for key, value in base_params.items()}
+    if base_params['ENGINE'] != 'hough' or base_params['PYRAMID_LEVELS']:
+        print("Tuning the full resolution Hough engine, ENGINE and PYRAMID_LEVELS are reset", file=sys.stderr)
+        base_params.update(ENGINE='hough', PYRAMID_LEVELS=0)
+    workers = args.workers or os.cpu_count()
+    rng = random.Random(args.seed)
+
+    ctx = mp.get_context('spawn')
+    start = time.perf_counter()
+    with ctx.Pool(workers, initializer=init_worker, initargs=(labels, TUNE_PARAMS['CACHE_MB'])) as pool:
+        tuner = Tuner(pool, workers, base_params, TUNE_PARAMS['MISS_PENALTY'])
+        baseline = tuner.run([{key: base_params[key] for key in space}], 'baseline: ')[0]
+        if args.search == 'grid':
+            tuner.run(grid_configs(space), 'grid: ')
+        else:
+            seen = {row['key'] for row in tuner.rows}
+            tuner.run(random_configs(space, args.samples, rng, seen), 'random: ')
+            # Bayesian-lite: spend the remaining evaluations next to the configurations on the front, most accurate first
+            for round_number in range(args.rounds if args.search == 'refine' else 0):
+                front = sorted(pareto_front(tuner.rows), key=lambda row: row['error'])
+                candidates, keys = [], {row['key'] for row in tuner.rows}
+                for row in front:
+                    for candidate in neighbours(row['params'], space):
+                        if config_key(candidate) not in keys:
+                            keys.add(config_key(candidate))
+                            candidates.append(candidate)
+                if not candidates:
+                    break
+                tuner.run(candidates[:TUNE_PARAMS['ROUND_SIZE']], f"round {round_number + 1}: ")
+    elapsed = time.perf_counter() - start
+
+    front = pareto_front(tuner.rows)
+    within = [row for row in front if args.budget_ms is None or row['frame_ms'] <= args.budget_ms]
+    picked = min(within or front, key=lambda row: row['error'])
+    if not within:
+        print(f"No configuration within {args.budget_ms} ms/frame, picked the most accurate one", file=sys.stderr)
+    frames = sum(label['max_frames'] for label in labels)
+    print(f"{len(tuner.rows)} configurations on up to {frames} frames of {len(labels)} recordings in {elapsed:.1f} s "
+          f"with {workers} workers, stage cache hit rate {tuner.hits / max(tuner.hits + tuner.misses, 1):.0%}")
+    columns = ['error', 'mae', 'p95', 'detected', 'frame_ms'] + list(space)
+    table = [dict(row, **row['params']) for row in front]
+    print("Pareto front (error in cm, a missed frame counts as "
+          f"{TUNE_PARAMS['MISS_PENALTY']} cm):")
+    print_table(table, columns)
+    print(f"Baseline: error {baseline['error']:.3f} cm, {baseline['frame_ms']:.2f} ms/frame; "
+          f"picked: error {picked['error']:.3f} cm, {picked['frame_ms']:.2f} ms/frame")
+
+    # The config that was tuned with the picked edge_params, loadable with --config; the front is kept for reference
+    def result(row):
+        return {'edge_params': row['params'], 'error': row['error'], 'mae': row['mae'], 'p95': row['p95'],
+                'detected': row['detected'], 'frame_ms': row['frame_ms']}
+    tuned = merge_config(config, {'edge_params': dict(config['edge_params'], **picked['params'])})
+    tuned['tuning'] = {'labels': args.labels, 'search': args.search, 'evaluated': len(tuner.rows),
+                       'budget_ms': args.budget_ms, 'baseline': result(baseline), 'front': [result(row) for row in front]}
+    with open(args.output, 'w') as f:
+        json.dump(tuned, f, indent=2)
+    print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,24 @@
+import argparse
+import os
+import sys
 import cv2
 import numpy as np
 import time
 
+# Calibration storage, undistortion maps and preprocessing chains are shared with the final pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'final'))
+from calibration import load_calibration, get_undistorter
+from detection import PREPROCESS_CHAINS
+
+parser = argparse.ArgumentParser(description='Measure object height in centimeters')
+parser.add_argument('--preprocess', type=str, default='bilateral', choices=sorted(PREPROCESS_CHAINS),
+                    help='Noise reduction chain applied before thresholding')
+parser.add_argument('--calibration', type=str, help='Calibration JSON file, frames are undistorted with its maps')
+parser.add_argument('--camera-name', type=str, default='1', help='Calibration key of the camera')
+args = parser.parse_args()
+preprocess = PREPROCESS_CHAINS[args.preprocess]
+undistorter, undistort_size = None, None  # Undistortion maps of the current frame size
+
 # Initialize webcam
 cap = cv2.VideoCapture(1)
 if not cap.isOpened():
@@ -67,10 +84,18 @@ while True:
     height, width = frame.shape[:2]
     scale_range = max(1, cv2.getTrackbarPos('Scale Range (cm)', 'Height Measurement (cm)'))
     
+    # Undistort with maps built once for this camera and resolution
+    if args.calibration and (width, height) != undistort_size:
+        undistort_size = (width, height)
+        camera_matrix, dist_coeffs = load_calibration(args.calibration, args.camera_name, undistort_size)
+        undistorter = get_undistorter(camera_matrix, dist_coeffs, undistort_size) if camera_matrix is not None else None
+    if undistorter is not None:
+        frame = undistorter.apply(frame)
+    
     # Process image for edge detection (simplified pipeline)
     gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    bilateral = cv2.bilateralFilter(gray, 9, 75, 75)
-    adaptive_thresh = cv2.adaptiveThreshold(bilateral, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    filtered = preprocess(gray)
+    adaptive_thresh = cv2.adaptiveThreshold(filtered, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
     edges = cv2.Canny(cv2.morphologyEx(adaptive_thresh, cv2.MORPH_OPEN, 
                      cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1))), *EDGE_PARAMS['CANNY_THRESHOLDS'])
     
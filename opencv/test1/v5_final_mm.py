@@ -1,9 +1,28 @@
+import argparse
+import os
+import sys
 import cv2
 import numpy as np
-import time
 
-# Initialize webcam and check if connected
-cap = cv2.VideoCapture(1)
+# Frame sources (camera, video file, image directory/glob) are shared with the final pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'final'))
+from sources import open_source
+from detection import PREPROCESS_CHAINS, filter_horizontal
+from overlay import composite_scale
+from calibration import load_calibration, get_undistorter
+
+parser = argparse.ArgumentParser(description='Measure object height in millimeters')
+parser.add_argument('--source', type=str, default='1', help='Camera index, video file, image directory or image glob')
+parser.add_argument('--realtime', action='store_true', help='Pace recorded sources at their frame rate instead of max speed')
+parser.add_argument('--preprocess', type=str, default='bilateral', choices=sorted(PREPROCESS_CHAINS),
+                    help='Noise reduction chain applied before thresholding')
+parser.add_argument('--calibration', type=str, help='Calibration JSON file, frames are undistorted with its maps')
+parser.add_argument('--camera-name', type=str, help='Calibration key of the camera (default: the source)')
+args = parser.parse_args()
+preprocess = PREPROCESS_CHAINS[args.preprocess]
+
+# Initialize webcam or recording and check if connected
+cap = open_source(args.source, realtime=args.realtime)
 if not cap.isOpened():
     print("Error: Could not open camera")
     exit()
@@ -20,58 +39,10 @@ stable_height = None
 height_history = []
 HISTORY_LENGTH = 10  # Number of frames to consider for stabilization
 STABILITY_THRESHOLD = 2.0  # Maximum allowed deviation for stable reading (mm)
-last_stable_time = 0
+last_stable_time = None
+undistorter, undistort_size = None, None  # Undistortion maps of the current frame size
 STABLE_DISPLAY_TIME = 3  # Seconds to show stable height before allowing new measurement
 
-def draw_scale(frame, scale_x, scale_y_bottom, scale_range):
-    """Draw measurement scale on the frame with given range in millimeters"""
-    height, width = frame.shape[:2]
-    scale_y_top = 20
-    scale_height = scale_y_bottom - scale_y_top
-    
-    # Draw main scale line
-    cv2.line(frame, (scale_x, 0), (scale_x, height), RED, 2)
-    
-    # Set tick intervals based on scale range
-    if scale_range <= 250:  # 25cm
-        major_tick = 50   # 5cm
-    elif scale_range <= 500:  # 50cm
-        major_tick = 100  # 10cm
-    elif scale_range <= 1000:  # 100cm
-        major_tick = 200  # 20cm
-    else:
-        major_tick = 500  # 50cm
-        
-    pixels_per_mm = scale_height / scale_range
-    
-    # Draw tick marks and labels
-    for i in range(0, scale_range + 1, 10):  # Step by 10mm increments
-        y_pos = int(scale_y_bottom - i * pixels_per_mm)
-        
-        if i % major_tick == 0:  # Major ticks
-            # Draw longer tick marks for major intervals
-            cv2.line(frame, (scale_x - 12, y_pos), (scale_x, y_pos), RED, 2)
-            
-            # Add text labels
-            cv2.putText(frame, f"{i} mm", (scale_x - 60, y_pos + 5), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, RED, 2)
-        
-        elif i % (major_tick // 5) == 0 and scale_range <= 500:  # Medium ticks
-            cv2.line(frame, (scale_x - 8, y_pos), (scale_x, y_pos), RED, 1)
-            
-            # Add small labels for medium ticks
-            cv2.putText(frame, f"{i}", (scale_x - 25, y_pos + 5), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.3, RED, 1)
-        
-        elif scale_range <= 250 and i % 10 == 0:  # Minor ticks for smaller ranges
-            cv2.line(frame, (scale_x - 4, y_pos), (scale_x, y_pos), RED, 1)
-    
-    # Add scale title
-    cv2.putText(frame, f"Scale (0-{scale_range}mm)", (scale_x - 120, 15), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.6, RED, 2)
-    
-    return pixels_per_mm
-
 def is_stable_measurement(history, new_value, threshold):
     """Check if measurement is stable within threshold"""
     if len(history) < HISTORY_LENGTH:
@@ -86,7 +57,7 @@ cv2.createTrackbar('Scale Range (mm)', 'Height Measurement (mm)', scale_range, 2
 
 while True:
     # Capture and process frame
-    ret, frame = cap.read()
+    ret, frame, frame_seq, frame_time = cap.read()
     if not ret:
         print("Failed to grab frame")
         break
@@ -94,10 +65,18 @@ while True:
     height, width = frame.shape[:2]
     scale_range = max(10, cv2.getTrackbarPos('Scale Range (mm)', 'Height Measurement (mm)'))
     
+    # Undistort with maps built once for this camera and resolution
+    if args.calibration and (width, height) != undistort_size:
+        undistort_size = (width, height)
+        camera_matrix, dist_coeffs = load_calibration(args.calibration, args.camera_name or args.source, undistort_size)
+        undistorter = get_undistorter(camera_matrix, dist_coeffs, undistort_size) if camera_matrix is not None else None
+    if undistorter is not None:
+        frame = undistorter.apply(frame)
+    
     # Process image for edge detection
     gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    bilateral = cv2.bilateralFilter(gray, 9, 75, 75)
-    adaptive_thresh = cv2.adaptiveThreshold(bilateral, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    filtered = preprocess(gray)
+    adaptive_thresh = cv2.adaptiveThreshold(filtered, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
     horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1))
     enhanced_horizontal = cv2.morphologyEx(adaptive_thresh, cv2.MORPH_OPEN, horizontal_kernel)
     edges = cv2.Canny(enhanced_horizontal, CANNY_THRESHOLD1, CANNY_THRESHOLD2)
@@ -106,39 +85,29 @@ while True:
     scale_x = width - 70
     scale_y_bottom = height - 20
     result = frame.copy()
-    pixels_per_mm = draw_scale(result, scale_x, scale_y_bottom, scale_range)
+    pixels_per_mm = composite_scale(result, scale_range, units='mm')
     
     # Detect lines
     lines = cv2.HoughLinesP(edges, 1, np.pi/180, HOUGH_THRESHOLD, minLineLength=MIN_LINE_LENGTH, maxLineGap=MAX_LINE_GAP)
     
-    # Current time for stability logic
-    current_time = time.time()
+    # Current time for stability logic (frame timestamp, so replays behave like the live camera)
+    current_time = frame_time
     found_new_measurement = False
     current_height = None
     
     # Process detected lines
     if lines is not None:
-        horizontal_lines = []
-        
-        # Find horizontal lines
-        for line in lines:
-            x1, y1, x2, y2 = line[0]
-            if x2 != x1 and abs((y2 - y1) / (x2 - x1)) < 0.1:
-                line_length = np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-                if line_length > MIN_LINE_LENGTH:
-                    horizontal_lines.append((x1, y1, x2, y2, y1))
+        # Find horizontal lines (filtered as arrays over all segments, sorted top to bottom)
+        horizontal_lines = filter_horizontal(lines, MIN_LINE_LENGTH)
         
         # If we have at least 2 horizontal lines
         if len(horizontal_lines) >= 2:
-            horizontal_lines.sort(key=lambda line: line[4])
             top_line = horizontal_lines[0]
             bottom_line = horizontal_lines[-1]
             
             # Calculate positions
-            top_x1, top_y1, top_x2, top_y2, _ = top_line
-            bot_x1, bot_y1, bot_x2, bot_y2, _ = bottom_line
-            top_y_avg = (top_y1 + top_y2) // 2
-            bot_y_avg = (bot_y1 + bot_y2) // 2
+            top_x1, top_x2, top_y_avg = (int(top_line[field]) for field in ('x1', 'x2', 'y_avg'))
+            bot_x1, bot_x2, bot_y_avg = (int(bottom_line[field]) for field in ('x1', 'x2', 'y_avg'))
             
             # Draw lines
             cv2.line(result, (top_x1, top_y_avg), (top_x2, top_y_avg), GREEN, 2)
@@ -182,7 +151,7 @@ while True:
             height_history.pop(0)
         
         # Check for stability
-        if current_time - last_stable_time > STABLE_DISPLAY_TIME and is_stable_measurement(height_history, current_height, STABILITY_THRESHOLD):
+        if (last_stable_time is None or current_time - last_stable_time > STABLE_DISPLAY_TIME) and is_stable_measurement(height_history, current_height, STABILITY_THRESHOLD):
             stable_height = sum(height_history) / len(height_history)
             last_stable_time = current_time
             print(f"New stable height measurement: {stable_height:.1f} mm")
@@ -247,7 +216,7 @@ while True:
         # Clear stable height to start new measurement
         stable_height = None
         height_history = []
-        last_stable_time = 0
+        last_stable_time = None
         print("Cleared stable height measurement")
 
 # Clean up
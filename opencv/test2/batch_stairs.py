@@ -0,0 +1,178 @@
+import argparse
+import collections
+import concurrent.futures
+import csv
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from test2 import analyze_stair  # test2 also puts final/ on sys.path
+from calibration import DEFAULT_CALIBRATION_FILE, IMAGE_EXTENSIONS, calibration_key, read_calibrations, get_undistorter
+
+# Columns of the results table
+FIELDS = ['path', 'width', 'height', 'line_count', 'stair_edge_y', 'stair_height_cm', 'annotated', 'error']
+
+# Settings of this worker process, filled in by the pool initializer
+_worker = {}
+
+def find_images(inputs, recursive=False):
+    """Image files named on the command line or found in the given directories, in a stable order"""
+    paths = []
+    for item in inputs:
+        if not os.path.isdir(item):
+            paths.append(item)
+            continue
+        for folder, subfolders, files in os.walk(item):
+            subfolders.sort()
+            paths += [os.path.join(folder, name) for name in sorted(files) if name.lower().endswith(IMAGE_EXTENSIONS)]
+            if not recursive:
+                break
+    return paths
+
+def _read_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def prefetch(paths, depth=2):
+    """Yield (path, file bytes) while a background thread already reads the next `depth` files"""
+    with concurrent.futures.ThreadPoolExecutor(1) as reader:
+        pending = collections.deque()
+        for path in paths:
+            pending.append((path, reader.submit(_read_bytes, path)))
+            if len(pending) > depth:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+def claim_output(path):
+    """Create path, or path_1, path_2 ... if it is taken, and return the name that was created"""
+    base, ext = os.path.splitext(path)
+    candidate, number = path, 0
+    while True:
+        try:
+            os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return candidate
+        except FileExistsError:
+            number += 1
+            candidate = f"{base}_{number}{ext}"
+
+def _init_worker(reference_height, calibrations, camera_name, annotated_dir, root):
+    # One OpenCV thread per process, the parallelism comes from the pool
+    cv2.setNumThreads(1)
+    _worker.update(reference_height=reference_height, calibrations=calibrations, camera_name=camera_name,
+                   annotated_dir=annotated_dir, root=root)
+
+def _undistorter(width, height):
+    entry = _worker['calibrations'].get(calibration_key(_worker['camera_name'], width, height))
+    if entry is None:
+        return None
+    return get_undistorter(np.array(entry['camera_matrix']), np.array(entry['dist_coeffs']), (width, height))
+
+def annotated_path(path):
+    """Where the annotated copy of an image goes, keeping the folder layout below the input root"""
+    relative = os.path.basename(path)
+    if _worker['root'] and not os.path.relpath(path, _worker['root']).startswith('..'):
+        relative = os.path.relpath(path, _worker['root'])
+    return os.path.join(_worker['annotated_dir'], os.path.splitext(relative)[0] + '_measured.jpg')
+
+def measure_image(path, data):
+    """Measure one encoded image and return its results row"""
+    row = dict.fromkeys(FIELDS, '')
+    row['path'] = path
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if data else None
+    if img is None:
+        row['error'] = 'unreadable'
+        return row
+    height, width = img.shape[:2]
+    row.update(width=width, height=height)
+
+    undistorter = _undistorter(width, height)
+    if undistorter is not None:
+        img = undistorter.apply(img)
+    annotate = bool(_worker['annotated_dir'])
+    measurement, result_img, _ = analyze_stair(img, _worker['reference_height'], annotate=annotate)
+    row.update({key: '' if value is None else value for key, value in measurement.items()})
+
+    if annotate:
+        target = annotated_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        target = claim_output(target)
+        cv2.imwrite(target, result_img)
+        row['annotated'] = target
+    return row
+
+def measure_chunk(paths):
+    """Measure a chunk of images in this worker, reading each next file in the background"""
+    rows = []
+    for path, data in prefetch(paths):
+        try:
+            rows.append(measure_image(path, data))
+        except Exception as e:
+            rows.append(dict(dict.fromkeys(FIELDS, ''), path=path, error=f"{type(e).__name__}: {e}"))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure stair edges over many images without a GUI')
+    parser.add_argument('inputs', nargs='+', help='Image files and/or directories of images')
+    parser.add_argument('--recursive', action='store_true', help='Also search subdirectories')
+    parser.add_argument('--output', type=str, default='stair_results.csv', help="Results CSV, '-' for stdout")
+    parser.add_argument('--annotated_dir', type=str, help='Write annotated copies here (existing files are never overwritten)')
+    parser.add_argument('--reference_height', type=float, help='Height of reference object in cm')
+    parser.add_argument('--calibration_file', type=str, default=DEFAULT_CALIBRATION_FILE,
+                        help='Saved calibrations, images are undistorted when there is an entry for their size')
+    parser.add_argument('--camera_name', type=str, default='default', help='Camera the images come from')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes')
+    parser.add_argument('--chunk_size', type=int, default=8, help='Images handed to a worker at a time')
+    args = parser.parse_args()
+
+    paths = find_images(args.inputs, args.recursive)
+    if not paths:
+        print("No images found")
+        return
+    root = args.inputs[0] if len(args.inputs) == 1 and os.path.isdir(args.inputs[0]) else None
+    calibrations = read_calibrations(args.calibration_file)
+    initargs = (args.reference_height, calibrations, args.camera_name, args.annotated_dir, root)
+    chunks = [paths[i:i + args.chunk_size] for i in range(0, len(paths), args.chunk_size)]
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    writer = csv.DictWriter(out, fieldnames=FIELDS)
+    writer.writeheader()
+    start, done, failed = time.time(), 0, 0
+    pool = None
+    try:
+        # Rows come back in input order while the workers already measure the following chunks
+        if args.processes > 1:
+            pool = mp.get_context('spawn').Pool(args.processes, initializer=_init_worker, initargs=initargs)
+            results = pool.imap(measure_chunk, chunks)
+        else:
+            _init_worker(*initargs)
+            results = map(measure_chunk, chunks)
+        for rows in results:
+            writer.writerows(rows)
+            done += len(rows)
+            failed += sum(1 for row in rows if row['error'])
+            if done % 500 < len(rows):
+                print(f"{done}/{len(paths)} images, {done / max(time.time() - start, 1e-9):.1f} images/s", file=sys.stderr)
+    finally:
+        # Every chunk has been collected (or we are bailing out), nothing is left to wait for
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"Measured {done} images ({failed} failed) in {elapsed:.1f} s ({done / elapsed:.1f} images/s) "
+          f"with {args.processes} processes", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,41 @@
 import cv2
 import numpy as np
 import argparse
+import os
+import sys
 
-def calibrate_camera(checker_image_path, checker_size=(9, 6), square_size=2.5):
+# Calibration storage and undistortion maps are shared with the final pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'final'))
+from calibration import DEFAULT_CALIBRATION_FILE, load_calibration, save_calibration, get_undistorter, calibrate_images
+
+def calibrate_camera(checker_path, checker_size=(9, 6), square_size=2.5, processes=None, cache_dir=None):
     """
     Calibrate camera using a checkerboard pattern.
+    checker_path: One checkerboard image or a directory of them (views of the board from different angles)
     checker_size: Number of inner corners (width, height)
     square_size: Size of each square in cm
+    Corners are found in a process pool and cached on disk, so only new images are searched on the next run.
+    Returns (camera_matrix, dist_coeffs, image size), all None if calibration failed.
     """
-    # Prepare object points (0,0,0), (1,0,0), (2,0,0) ...
-    objp = np.zeros((checker_size[0] * checker_size[1], 3), np.float32)
-    objp[:, :2] = np.mgrid[0:checker_size[0], 0:checker_size[1]].T.reshape(-1, 2) * square_size
-    
-    # Read calibration image
-    img = cv2.imread(checker_image_path)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    # Find chessboard corners
-    ret, corners = cv2.findChessboardCorners(gray, checker_size, None)
-    
-    if ret:
-        # Get camera matrix and distortion coefficients
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-        corners2 = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-        
-        ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(
-            [objp], [corners2], gray.shape[::-1], None, None
-        )
-        return mtx, dist
-    else:
+    result = calibrate_images(checker_path, checker_size, square_size, cache_dir, processes)
+    if result is None:
         print("Couldn't find checkerboard pattern. Camera calibration failed.")
-        return None, None
+        return None, None, None
+    
+    # Report the reprojection error of every view so bad images can be removed
+    for image_path, error in result['views']:
+        print(f"  {os.path.basename(image_path)}: reprojection error {error:.3f} px")
+    for image_path, reason in result['skipped']:
+        print(f"  {os.path.basename(image_path)}: skipped ({reason})")
+    print(f"Calibrated from {len(result['views'])} views, RMS reprojection error {result['rms']:.3f} px")
+    return result['camera_matrix'], result['dist_coeffs'], result['size']
 
-def measure_stair_height(image_path, reference_object_height=None, camera_height=0, camera_matrix=None, dist_coeffs=None):
+def analyze_stair(img, reference_object_height=None, annotate=True):
     """
-    Measure the height of the first stair step.
-    
-    Parameters:
-    - image_path: Path to the stair image
-    - reference_object_height: Height of reference object in cm (if available)
-    - camera_height: Height of camera from ground in cm
-    - camera_matrix, dist_coeffs: Camera calibration parameters
+    Find potential stair edges in an (undistorted) image without any GUI.
+    Returns (measurement, result image or None, edges). measurement holds line_count, the lowest
+    horizontal edge stair_edge_y and, with a reference object height, stair_height_cm.
     """
-    # Read image
-    img = cv2.imread(image_path)
-    if img is None:
-        print(f"Could not read image: {image_path}")
-        return
-    
-    # Undistort image if calibration parameters are available
-    if camera_matrix is not None and dist_coeffs is not None:
-        img = cv2.undistort(img, camera_matrix, dist_coeffs)
-    
     # Convert to grayscale
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
@@ -65,7 +49,7 @@ def measure_stair_height(image_path, reference_object_height=None, camera_height
     lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=100, minLineLength=100, maxLineGap=10)
     
     # Create a copy of the original image for visualization
-    result_img = img.copy()
+    result_img = img.copy() if annotate else None
     
     # Filter horizontal lines (potential stair edges)
     horizontal_lines = []
@@ -76,12 +60,17 @@ def measure_stair_height(image_path, reference_object_height=None, camera_height
             if abs(x2 - x1) > 0:  # Avoid division by zero
                 slope = abs((y2 - y1) / (x2 - x1))
                 if slope < 0.1:  # Threshold for horizontal lines
-                    cv2.line(result_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                    if annotate:
+                        cv2.line(result_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
                     horizontal_lines.append((x1, y1, x2, y2))
     
+    # For demonstration purposes, assuming the lowest horizontal line is the stair edge
+    measurement = {'line_count': len(horizontal_lines), 'stair_edge_y': None, 'stair_height_cm': None}
+    if horizontal_lines:
+        measurement['stair_edge_y'] = int(max([y1 for x1, y1, x2, y2 in horizontal_lines]))
+    
     # If reference object is used
-    if reference_object_height is not None:
-        print("Using reference object method for stair height measurement")
+    if reference_object_height is not None and horizontal_lines:
         # Here you would implement code to detect the reference object and calculate the pixel-to-cm ratio
         # For simplicity, this part is not fully implemented
         # In a real implementation, you would need to detect the reference object and use its known height
@@ -90,18 +79,43 @@ def measure_stair_height(image_path, reference_object_height=None, camera_height
         # Placeholder:
         pixel_to_cm_ratio = 0.1  # This would be calculated based on the reference object
         
-        # For demonstration purposes, assuming the lowest horizontal line is the stair edge
-        if horizontal_lines:
-            stair_edge_y = max([y1 for x1, y1, x2, y2 in horizontal_lines])
-            image_height = img.shape[0]
-            stair_height_pixels = image_height - stair_edge_y
-            stair_height_cm = stair_height_pixels * pixel_to_cm_ratio
-            print(f"Estimated stair height: {stair_height_cm:.2f} cm")
-            
-            # Draw the measurement
+        stair_edge_y = measurement['stair_edge_y']
+        image_height = img.shape[0]
+        stair_height_pixels = image_height - stair_edge_y
+        measurement['stair_height_cm'] = stair_height_cm = stair_height_pixels * pixel_to_cm_ratio
+        
+        # Draw the measurement
+        if annotate:
             cv2.line(result_img, (img.shape[1]//2, image_height), (img.shape[1]//2, stair_edge_y), (0, 0, 255), 2)
             cv2.putText(result_img, f"{stair_height_cm:.2f} cm", (img.shape[1]//2 + 10, (image_height + stair_edge_y)//2), 
                         cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+    return measurement, result_img, edges
+
+def measure_stair_height(image_path, reference_object_height=None, camera_height=0, camera_matrix=None, dist_coeffs=None):
+    """
+    Measure the height of the first stair step.
+    
+    Parameters:
+    - image_path: Path to the stair image
+    - reference_object_height: Height of reference object in cm (if available)
+    - camera_height: Height of camera from ground in cm
+    - camera_matrix, dist_coeffs: Camera calibration parameters
+    """
+    # Read image
+    img = cv2.imread(image_path)
+    if img is None:
+        print(f"Could not read image: {image_path}")
+        return
+    
+    # Undistort image if calibration parameters are available (maps are built once per size and reused)
+    if camera_matrix is not None and dist_coeffs is not None:
+        img = get_undistorter(camera_matrix, dist_coeffs, img.shape[1::-1]).apply(img)
+    
+    measurement, result_img, edges = analyze_stair(img, reference_object_height)
+    if reference_object_height is not None:
+        print("Using reference object method for stair height measurement")
+        if measurement['stair_height_cm'] is not None:
+            print(f"Estimated stair height: {measurement['stair_height_cm']:.2f} cm")
     else:
         print("No reference object provided. Only detecting potential stair edges.")
     
@@ -118,15 +132,28 @@ def measure_stair_height(image_path, reference_object_height=None, camera_height
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Measure stair height from an image')
     parser.add_argument('image_path', type=str, help='Path to the stair image')
-    parser.add_argument('--calibration', type=str, help='Path to checkerboard image for calibration')
+    parser.add_argument('--calibration', type=str, help='Checkerboard image or directory of checkerboard images for calibration')
+    parser.add_argument('--processes', type=int, help='Processes for checkerboard corner detection (default: all cores)')
     parser.add_argument('--reference_height', type=float, help='Height of reference object in cm')
     parser.add_argument('--camera_height', type=float, default=0, help='Height of camera from ground in cm')
+    parser.add_argument('--calibration_file', type=str, default=DEFAULT_CALIBRATION_FILE,
+                        help='Saved calibrations, keyed by camera name and resolution')
+    parser.add_argument('--camera_name', type=str, default='default', help='Camera the images come from')
     
     args = parser.parse_args()
     
+    # Use a saved calibration for this camera and image size, otherwise calibrate and save it
     camera_matrix, dist_coeffs = None, None
+    image = cv2.imread(args.image_path)
+    if image is not None and not args.calibration:
+        camera_matrix, dist_coeffs = load_calibration(args.calibration_file, args.camera_name, image.shape[1::-1])
+        if camera_matrix is not None:
+            print(f"Using saved calibration from {args.calibration_file}")
     if args.calibration:
-        camera_matrix, dist_coeffs = calibrate_camera(args.calibration)
+        camera_matrix, dist_coeffs, calibration_size = calibrate_camera(args.calibration, processes=args.processes)
+        if camera_matrix is not None:
+            save_calibration(args.calibration_file, args.camera_name, calibration_size, camera_matrix, dist_coeffs)
+            print(f"Calibration saved to {args.calibration_file}")
     
     measure_stair_height(
         args.image_path, 
@@ -0,0 +1,60 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Frame loading and table printing are shared with the pipeline benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'final'))
+from benchmark import load_frames, print_table
+from detector import YoloDetector
+
+def bench_setting(frames, weights, backend, imgsz, batch, threads, repeats):
+    """Time batched inference over the frames for one setting and return a result row"""
+    detector = YoloDetector(weights, imgsz, threads, backend)
+    batches = [frames[i:i + batch] for i in range(0, len(frames) - batch + 1, batch)]
+    detector.predict(batches[0])  # Warm-up
+    batch_ms = []
+    for _ in range(repeats):
+        for frames_in_batch in batches:
+            start = time.perf_counter()
+            detector.predict(frames_in_batch)
+            batch_ms.append((time.perf_counter() - start) * 1000)
+    batch_ms = np.array(batch_ms)
+    return {'backend': backend, 'imgsz': imgsz, 'batch': batch, 'threads': threads or 'default',
+            'batch_ms': float(batch_ms.mean()), 'frame_ms': float(batch_ms.mean() / batch),
+            'p95_batch_ms': float(np.percentile(batch_ms, 95)), 'fps': float(1000 * batch / batch_ms.mean())}
+
+def main():
+    parser = argparse.ArgumentParser(description='YOLO CPU throughput for each backend, input size, batch size and thread count')
+    parser.add_argument('--source', type=str, required=True, help='Video file, image directory or glob to take frames from')
+    parser.add_argument('--frames', type=int, default=32, help='Frames to load')
+    parser.add_argument('--weights', type=str, default='yolov8n.pt', help='YOLO weights')
+    parser.add_argument('--backends', type=str, default='torch,onnx', help='Comma separated backends')
+    parser.add_argument('--imgsz', type=str, default='320,640', help='Comma separated input sizes')
+    parser.add_argument('--batch', type=str, default='1,4,8', help='Comma separated batch sizes')
+    parser.add_argument('--threads', type=str, default=str(os.cpu_count()), help='Comma separated torch thread counts (onnx runs with the onnxruntime default)')
+    parser.add_argument('--repeats', type=int, default=2, help='Passes over the frames')
+    parser.add_argument('--json', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    frames = load_frames(args.source, args.frames)
+    # The thread count only reaches torch, onnx settings run once with onnxruntime's default
+    threads = [int(n) for n in args.threads.split(',')]
+    settings = [(backend, imgsz, batch, thread_count)
+                for backend, imgsz, batch in itertools.product(args.backends.split(','), [int(n) for n in args.imgsz.split(',')],
+                                                               [int(n) for n in args.batch.split(',')])
+                for thread_count in (threads if backend != 'onnx' else [None])]
+    rows = [bench_setting(frames, args.weights, backend, imgsz, batch, threads, args.repeats)
+            for backend, imgsz, batch, threads in settings if batch <= len(frames)]
+    print(f"{len(frames)} frames from {args.source}")
+    print_table(rows, ['backend', 'imgsz', 'batch', 'threads', 'batch_ms', 'frame_ms', 'p95_batch_ms', 'fps'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'argv': sys.argv[1:], 'time': time.time(), 'cpus': os.cpu_count(), 'rows': rows}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+
+import numpy as np
+from ultralytics import YOLO
+
+BACKENDS = ('torch', 'onnx')
+
+def has_display():
+    """True when windows can be shown (always on Windows/macOS, X11 or Wayland on Linux)"""
+    if not sys.platform.startswith('linux'):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def export_onnx(weights, imgsz):
+    """Export weights to <name>_<imgsz>.onnx next to them once (dynamic batch axis) and return its path"""
+    onnx_path = f"{os.path.splitext(weights)[0]}_{imgsz}.onnx"
+    if not os.path.exists(onnx_path):
+        exported = YOLO(weights).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        os.replace(exported, onnx_path)
+    return onnx_path
+
+def result_boxes(result):
+    """(x0, y0, x1, y1) boxes, confidences and class ids of a YOLO result as numpy arrays"""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, int)
+    return boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy().astype(int)
+
+class YoloDetector:
+    """YOLO model with a fixed input size and thread count that runs a list of frames as one batch.
+
+    backend 'onnx' exports the weights once and runs them on onnxruntime's CPU provider.
+    threads sets torch's intra-op thread count (None keeps torch's default). It does not reach the onnxruntime
+    session, which ultralytics creates with onnxruntime's default thread count, so it is ignored for 'onnx'.
+    """
+
+    def __init__(self, weights='yolov8n.pt', imgsz=640, threads=None, backend='torch', conf=0.25, classes=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+        if threads and backend == 'onnx':
+            print(f"threads={threads} is ignored by the onnx backend, onnxruntime uses its default", file=sys.stderr)
+            threads = None
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        self.imgsz, self.conf, self.classes, self.backend, self.threads = imgsz, conf, classes, backend, threads
+        self.model = YOLO(export_onnx(weights, imgsz) if backend == 'onnx' else weights, task='detect')
+
+    def predict(self, frames):
+        """Detect objects in all frames with one forward pass and return one Results object per frame"""
+        return self.model.predict(list(frames), imgsz=self.imgsz, conf=self.conf, classes=self.classes,
+                                  device='cpu', verbose=False)
+
+class Throughput:
+    """Frames, batches and inference time of a run, reported as frames per second.
+
+    With tracking, detected counts the frames that went through the detector and the summary adds the
+    detector duty cycle (detected / all frames).
+    """
+
+    def __init__(self):
+        self.frames, self.detected, self.batches, self.infer_seconds, self.start = 0, 0, 0, 0.0, time.time()
+
+    def add(self, frames, seconds, detected=None):
+        self.frames += frames
+        self.detected += frames if detected is None else detected
+        self.batches += 1
+        self.infer_seconds += seconds
+
+    def summary(self, settings):
+        elapsed = max(time.time() - self.start, 1e-9)
+        infer = max(self.infer_seconds, 1e-9)
+        return (f"{settings}: {self.frames} frames in {self.batches} batches, "
+                f"{self.frames / elapsed:.1f} fps overall, {self.frames / infer:.1f} fps inference, "
+                f"{1000 * infer / max(self.batches, 1):.1f} ms per batch"
+                + (f", detector duty cycle {100 * self.detected / self.frames:.1f}% ({self.detected} frames)"
+                   if self.detected < self.frames else ""))
@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+# The edge-based measurement lives in the final pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'final'))
+from config import load_config
+from sources import open_source
+from Height_detection import run
+from sinks import open_output, close_output
+from detector import BACKENDS, YoloDetector, result_boxes
+from tracker import BoxTracker
+
+def pick_box(xyxy, conf):
+    """The (x0, y0, x1, y1) box with the largest area x confidence, None if there is none"""
+    if len(xyxy) == 0:
+        return None
+    areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    return tuple(float(v) for v in xyxy[int(np.argmax(areas * conf))])
+
+def pad_box(box, pad, width, height):
+    """Grow a box by pad times its size on every side and clip it to the frame, in whole pixels"""
+    x0, y0, x1, y1 = box
+    pad_x, pad_y = (x1 - x0) * pad, (y1 - y0) * pad
+    return (int(max(0, x0 - pad_x)), int(max(0, y0 - pad_y)),
+            int(min(width, np.ceil(x1 + pad_x))), int(min(height, np.ceil(y1 + pad_y))))
+
+class DetectorGuide:
+    """ROI provider for Height_detection.run that runs the detector every `every` frames.
+
+    The padded box of the last detection is measured until the next detector run. With a tracker the box
+    follows the object between detections and the detector runs when the tracker asks for it (at most
+    `every` frames apart). Without a box the whole frame is measured (fallback 'full') or the frame is
+    skipped (fallback 'skip').
+    """
+
+    def __init__(self, detector, every=10, pad=0.1, fallback='skip', tracker=None):
+        self.detector, self.every, self.pad, self.fallback, self.tracker = detector, max(1, every), pad, fallback, tracker
+        self.box, self.frames, self.detector_runs, self.misses, self.measured_area = None, 0, 0, 0, 0.0
+        self.track = None
+
+    def __call__(self, frame, frame_seq):
+        height, width = frame.shape[:2]
+        if self.tracker is not None:
+            self.box = self._track(frame)
+        elif self.frames % self.every == 0:
+            self.box = pick_box(*result_boxes(self.detector.predict([frame])[0])[:2])
+            self.detector_runs += 1
+        self.frames += 1
+        if self.box is None:
+            self.misses += 1
+            if self.fallback == 'skip':
+                return None
+            self.measured_area += 1.0
+            return []
+        roi = pad_box(self.box, self.pad, width, height)
+        self.measured_area += (roi[2] - roi[0]) * (roi[3] - roi[1]) / (width * height)
+        return [roi]
+
+    def _track(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self.tracker.needs_detection():
+            self.tracker.update(gray, *result_boxes(self.detector.predict([frame])[0]))
+            self.detector_runs += 1
+        else:
+            self.tracker.step(gray)
+        tracks = self.tracker.tracks
+        if not tracks:
+            self.track = None
+            return None
+        # Same choice as pick_box: the largest area x detector confidence
+        boxes = np.array([t.box for t in tracks])
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        self.track = tracks[int(np.argmax(areas * np.array([t.score for t in tracks])))]
+        return tuple(float(v) for v in self.track.box)
+
+    def measured(self, height):
+        """Keep the height measured inside the box on the track it came from"""
+        if self.track is not None:
+            self.track.measured_height = height
+
+    def summary(self):
+        frames = max(self.frames, 1)
+        return (f"Detector ran on {self.detector_runs} of {self.frames} frames "
+                f"({100 * self.detector_runs / frames:.1f}% duty cycle), no object in {self.misses} frames, "
+                f"edge search covered {100 * self.measured_area / frames:.1f}% of the pixels on average")
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure height with edges and lines only inside the box a YOLO detector finds')
+    parser.add_argument('--config', type=str, help='Path to a JSON config file')
+    parser.add_argument('--source', type=str, help='Camera index, video file, image directory or image glob')
+    parser.add_argument('--realtime', action='store_true', help='Pace recorded sources at their frame rate instead of max speed')
+    parser.add_argument('--headless', action='store_true', help='No GUI, write JSON lines measurements instead')
+    parser.add_argument('--output', type=str, help="Headless output file, '-' for stdout")
+    parser.add_argument('--scale-range', type=int, help='Scale range in cm (replaces the trackbar in headless mode)')
+    parser.add_argument('--weights', type=str, default='yolov8n.pt', help='YOLO weights')
+    parser.add_argument('--imgsz', type=int, default=320, help='Detector input size')
+    parser.add_argument('--threads', type=int, help='Torch CPU threads (default: torch decides)')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS, help='torch, or onnx on onnxruntime CPU')
+    parser.add_argument('--conf', type=float, default=0.4, help='Detector confidence threshold')
+    parser.add_argument('--classes', type=str, default='6', help='Comma separated COCO class ids to look for (6 = train)')
+    parser.add_argument('--every', type=int, default=10, help='Run the detector every K frames (with --track: at most K apart)')
+    parser.add_argument('--track', action='store_true', help='Follow the box with optical flow between detector runs')
+    parser.add_argument('--min-track-confidence', type=float, default=0.5,
+                        help='Run the detector again when a track drops below this confidence')
+    parser.add_argument('--pad', type=float, default=0.1, help='Padding around the box as a fraction of its size')
+    parser.add_argument('--fallback', type=str, default='skip', choices=('skip', 'full'),
+                        help='Without a detected object skip the frame or measure the whole frame')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    for key, value in [('source', args.source), ('output', args.output), ('scale_range', args.scale_range)]:
+        if value is not None:
+            config[key] = value
+    config['headless'] = config['headless'] or args.headless
+    config['realtime'] = config['realtime'] or args.realtime
+
+    classes = [int(c) for c in args.classes.split(',')] if args.classes else None
+    detector = YoloDetector(args.weights, args.imgsz, args.threads, args.backend, args.conf, classes)
+    tracker = None
+    if args.track:
+        tracker = BoxTracker({'MAX_INTERVAL': args.every, 'MIN_CONFIDENCE': args.min_track_confidence})
+    guide = DetectorGuide(detector, args.every, args.pad, args.fallback, tracker)
+
+    source = open_source(config['source'], realtime=config['realtime'])
+    if not source.isOpened():
+        print(f"Error: Could not open source {config['source']}")
+        exit()
+    out = open_output(config, config['headless'])
+    try:
+        run(source, config, out, roi_provider=guide)
+    finally:
+        close_output(out)
+        source.release()
+        if not config['headless']:
+            cv2.destroyAllWindows()
+    print(guide.summary(), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
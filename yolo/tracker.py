@@ -0,0 +1,152 @@
+import cv2
+import numpy as np
+
+# Tracking settings: most frames between detector keyframes (fewer while nothing is tracked),
+# IoU needed to match a detection to a track, track confidence below which the detector runs again,
+# keyframes a track survives unmatched, flow points per box, forward-backward error limit (px) and the
+# margin (px) around the tracked boxes that optical flow works in
+TRACKER_PARAMS = {'MAX_INTERVAL': 30, 'EMPTY_INTERVAL': 5, 'IOU_THRESHOLD': 0.3, 'MIN_CONFIDENCE': 0.5,
+                  'MAX_MISSES': 1, 'MAX_POINTS': 40, 'FB_ERROR': 1.0, 'CONFIDENCE_DECAY': 0.99,
+                  'SEARCH_MARGIN': 32}
+
+LK_PARAMS = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+def iou_matrix(a, b):
+    """IoU of every (x0, y0, x1, y1) box in a (N x 4) with every box in b (M x 4)"""
+    a, b = np.asarray(a, float).reshape(-1, 1, 4), np.asarray(b, float).reshape(1, -1, 4)
+    width = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    height = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = width * height
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+def match_boxes(ious, threshold):
+    """Greedy one-to-one (row, col) pairs in order of decreasing IoU, each at least threshold"""
+    pairs, used_rows, used_cols = [], set(), set()
+    for flat in np.argsort(-ious, axis=None):
+        row, col = np.unravel_index(flat, ious.shape)
+        if ious[row, col] < threshold:
+            break
+        if row not in used_rows and col not in used_cols:
+            pairs.append((int(row), int(col)))
+            used_rows.add(row)
+            used_cols.add(col)
+    return pairs
+
+class Track:
+    """One tracked object: its box, motion, confidence and the heights measured for it.
+
+    score is the detector confidence of the last matched detection, confidence is how much the tracked
+    box can still be trusted (1 right after a detection, lower as flow points get lost and frames pass).
+    """
+
+    def __init__(self, track_id, box, score, cls):
+        self.id, self.cls, self.score = track_id, cls, score
+        self.box, self.velocity = np.array(box, float), np.zeros(2)
+        self.confidence, self.misses = 1.0, 0
+        self.points, self.initial_points, self.frames_tracked = None, 0, 0
+        self.height = self.box[3] - self.box[1]  # Box height in pixels, carried between keyframes
+        self.measured_height = None  # Set by callers that measure the object (e.g. with edges)
+
+class BoxTracker:
+    """Keeps object boxes moving between detector keyframes with sparse optical flow.
+
+    update() takes the detections of a keyframe and matches them to the tracks by IoU, step() moves
+    every track by the median Lucas-Kanade flow of its points (or its velocity when the points are lost)
+    and lowers its confidence; needs_detection() tells when the detector has to run again.
+    """
+
+    def __init__(self, params=None):
+        self.params = dict(TRACKER_PARAMS, **(params or {}))
+        self.tracks, self.next_id, self.prev_gray, self.since_detection = [], 1, None, 0
+
+    def needs_detection(self):
+        """True on the first frame, after the keyframe interval, or when some track became unreliable"""
+        if self.prev_gray is None:
+            return True
+        interval = self.params['MAX_INTERVAL'] if self.tracks else self.params['EMPTY_INTERVAL']
+        return (self.since_detection >= interval or
+                any(track.confidence < self.params['MIN_CONFIDENCE'] for track in self.tracks))
+
+    def update(self, gray, boxes, scores, classes):
+        """Keyframe: match the detections to the tracks, start tracks for new objects and drop lost ones"""
+        boxes = np.asarray(boxes, float).reshape(-1, 4)
+        pairs = match_boxes(iou_matrix([t.box for t in self.tracks], boxes), self.params['IOU_THRESHOLD'])
+        matched_tracks, matched_boxes = {row for row, _ in pairs}, {col for _, col in pairs}
+
+        for row, col in pairs:
+            track = self.tracks[row]
+            shift = (boxes[col, :2] + boxes[col, 2:]) / 2 - (track.box[:2] + track.box[2:]) / 2
+            track.velocity = 0.5 * track.velocity + 0.5 * shift / max(self.since_detection, 1)
+            track.box, track.score, track.confidence, track.misses = boxes[col], scores[col], 1.0, 0
+            track.height = boxes[col, 3] - boxes[col, 1]
+        kept = []
+        for index, track in enumerate(self.tracks):
+            if index not in matched_tracks:
+                track.misses += 1
+                track.confidence *= 0.5
+            if track.misses <= self.params['MAX_MISSES']:
+                kept.append(track)
+        for col in range(len(boxes)):
+            if col not in matched_boxes:
+                kept.append(Track(self.next_id, boxes[col], scores[col], classes[col]))
+                self.next_id += 1
+        self.tracks = kept
+
+        self._sample_points(gray)
+        self.prev_gray, self.since_detection = gray, 0
+
+    def _sample_points(self, gray):
+        height, width = gray.shape
+        for track in self.tracks:
+            x0, y0 = max(0, int(track.box[0])), max(0, int(track.box[1]))
+            x1, y1 = min(width, int(np.ceil(track.box[2]))), min(height, int(np.ceil(track.box[3])))
+            points = None
+            if x1 - x0 > 4 and y1 - y0 > 4:
+                points = cv2.goodFeaturesToTrack(gray[y0:y1, x0:x1], self.params['MAX_POINTS'], 0.01, 5)
+            if points is not None:
+                points = points + np.float32([x0, y0])
+            track.points, track.initial_points, track.frames_tracked = points, 0 if points is None else len(points), 0
+
+    def step(self, gray):
+        """Between keyframes: move the tracks to this frame and update their confidence"""
+        self.since_detection += 1
+        owners = [i for i, track in enumerate(self.tracks) if track.points is not None and len(track.points)]
+        if owners:
+            points = np.concatenate([self.tracks[i].points for i in owners])
+            owner_of = np.concatenate([np.full(len(self.tracks[i].points), i) for i in owners])
+
+            # Flow only inside the tracked boxes plus a margin for the motion, the image pyramids are the main cost
+            margin = self.params['SEARCH_MARGIN'] + int(max(np.abs(self.tracks[i].velocity).max() for i in owners))
+            x0, y0 = (max(0, int(v) - margin) for v in points.reshape(-1, 2).min(axis=0))
+            x1, y1 = int(points[..., 0].max()) + margin + 1, int(points[..., 1].max()) + margin + 1
+            prev_crop, crop, offset = self.prev_gray[y0:y1, x0:x1], gray[y0:y1, x0:x1], np.float32([x0, y0])
+
+            # Forward then backward flow, points that do not come back to where they started are dropped
+            start = points - offset
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_crop, crop, start, None, **LK_PARAMS)
+            back, back_status, _ = cv2.calcOpticalFlowPyrLK(crop, prev_crop, moved, None, **LK_PARAMS)
+            error = np.linalg.norm((back - start).reshape(-1, 2), axis=1)
+            moved = moved + offset
+            good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < self.params['FB_ERROR'])
+        for index, track in enumerate(self.tracks):
+            track.frames_tracked += 1
+            decay = self.params['CONFIDENCE_DECAY'] ** track.frames_tracked
+            mine = good & (owner_of == index) if owners else np.zeros(0, bool)
+            if mine.sum() >= 3:
+                shift = np.median((moved[mine] - points[mine]).reshape(-1, 2), axis=0)
+                track.velocity = 0.5 * track.velocity + 0.5 * shift
+                track.points = moved[mine]
+                track.confidence = decay * len(track.points) / track.initial_points
+            elif track.initial_points < 3:
+                # Nothing to follow in a flat box: the motion model with the plain time decay
+                shift = track.velocity
+                track.confidence = decay
+            else:
+                # Points lost: coast on the motion model and ask for a detection soon
+                shift = track.velocity
+                track.points = None
+                track.confidence *= 0.5
+            track.box = track.box + np.tile(shift, 2)
+        self.prev_gray = gray
@@ -1,31 +1,141 @@
+import argparse
+import os
+import sys
+import time
 import cv2
-from ultralytics import YOLO
-
-# Load a pretrained YOLOv8 model
-model = YOLO('yolov8n.pt')
-
-# Open webcam
-cap = cv2.VideoCapture(1)
-
-while True:
-    # Read frame
-    ret, frame = cap.read()
-    if not ret:
-        break
-    
-    # Run detection on the frame
-    results = model(frame)
-    
-    # Visualize results on the frame
-    annotated_frame = results[0].plot()
-    
-    # Display the result
-    cv2.imshow("Object Detection", annotated_frame)
-    
-    # Press 'q' to quit
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-# Release resources
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+
+# Frame sources (camera, video file, image directory/glob) are shared with the final pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'final'))
+from sources import open_source
+from detector import BACKENDS, YoloDetector, Throughput, has_display, result_boxes
+from tracker import BoxTracker
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run YOLO object detection on cameras or recordings')
+    parser.add_argument('--source', type=str, action='append',
+                        help='Camera index, video file, image directory or image glob (repeat for several cameras)')
+    parser.add_argument('--realtime', action='store_true', help='Pace recorded sources at their frame rate instead of max speed')
+    parser.add_argument('--weights', type=str, default='yolov8n.pt', help='YOLO weights')
+    parser.add_argument('--batch', type=int, default=1, help='Frames taken from each source per forward pass')
+    parser.add_argument('--imgsz', type=int, default=640, help='Fixed inference size')
+    parser.add_argument('--threads', type=int, help='Torch CPU threads (default: torch decides)')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS, help='torch, or onnx on onnxruntime CPU')
+    parser.add_argument('--conf', type=float, default=0.25, help='Confidence threshold')
+    parser.add_argument('--track', action='store_true',
+                        help='Run the detector on keyframes only and follow the boxes with optical flow in between')
+    parser.add_argument('--keyframe-every', type=int, default=30, help='With --track: most frames between detector runs')
+    parser.add_argument('--min-track-confidence', type=float, default=0.5,
+                        help='With --track: run the detector again when a track drops below this confidence')
+    parser.add_argument('--no-display', action='store_true', help='Never draw or show results')
+    parser.add_argument('--report-every', type=float, default=10.0, help='Seconds between throughput reports')
+    return parser.parse_args()
+
+def read_batch(sources, batch):
+    """Take `batch` frames from each open source, return (frames, source index of each frame); ended sources are closed"""
+    frames, owners = [], []
+    for index, cap in enumerate(sources):
+        for _ in range(batch):
+            if cap is None:
+                break
+            ret, frame, frame_seq, frame_time = cap.read()
+            if not ret:
+                cap.release()
+                sources[index] = cap = None
+                break
+            # Live captures reuse their buffer on the next read
+            frames.append(frame.copy())
+            owners.append(index)
+    return frames, owners
+
+def draw_tracks(frame, tracks):
+    """Draw the tracked boxes with their id, confidence and height in pixels"""
+    for track in tracks:
+        x0, y0, x1, y1 = (int(v) for v in track.box)
+        cv2.rectangle(frame, (x0, y0), (x1, y1), (0, 255, 0), 2)
+        label = f"#{track.id} {track.confidence:.2f} h={track.height:.0f}px"
+        if track.measured_height is not None:
+            label += f" ({track.measured_height:.1f} cm)"
+        cv2.putText(frame, label, (x0, max(12, y0 - 5)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+    return frame
+
+def track_batch(detector, trackers, frames, owners):
+    """Detect on the frames whose tracker asks for a keyframe (one forward pass), track the rest.
+
+    Returns the number of frames that went through the detector.
+    """
+    grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+    keyframes = [i for i, owner in enumerate(owners) if trackers[owner].needs_detection()]
+    results = detector.predict([frames[i] for i in keyframes]) if keyframes else []
+    detections = dict(zip(keyframes, results))
+    for i, owner in enumerate(owners):
+        if i in detections:
+            trackers[owner].update(grays[i], *result_boxes(detections[i]))
+        else:
+            trackers[owner].step(grays[i])
+    return len(keyframes)
+
+def main():
+    args = parse_args()
+    specs = args.source or ['1']
+    sources = [open_source(spec, realtime=args.realtime) for spec in specs]
+    for spec, cap in zip(specs, sources):
+        if not cap.isOpened():
+            print(f"Error: Could not open source {spec}")
+            exit()
+
+    # Load a pretrained YOLOv8 model with fixed input size and thread count
+    detector = YoloDetector(args.weights, args.imgsz, args.threads, args.backend, args.conf)
+    display = has_display() and not args.no_display
+    # Tracking goes frame by frame, so each source gives one frame per step and only keyframes are batched
+    batch = 1 if args.track else args.batch
+    trackers = None
+    if args.track:
+        params = {'MAX_INTERVAL': args.keyframe_every, 'MIN_CONFIDENCE': args.min_track_confidence}
+        trackers = [BoxTracker(params) for _ in specs]
+    settings = (f"backend={args.backend} imgsz={args.imgsz} batch={batch}x{len(specs)} "
+                f"threads={args.threads or 'default'}" + (f" track<={args.keyframe_every}" if args.track else ""))
+    meter, last_report = Throughput(), time.time()
+
+    try:
+        while any(cap is not None for cap in sources):
+            frames, owners = read_batch(sources, batch)
+            if not frames:
+                break
+
+            # Run detection on the whole batch in one forward pass (only on keyframes when tracking)
+            start = time.perf_counter()
+            if trackers:
+                detected = track_batch(detector, trackers, frames, owners)
+            else:
+                results = detector.predict(frames)
+                detected = len(frames)
+            meter.add(len(frames), time.perf_counter() - start, detected)
+            if time.time() - last_report >= args.report_every:
+                print(meter.summary(settings), file=sys.stderr)
+                last_report = time.time()
+
+            # Visualize the newest result of each camera, only when someone can see it
+            if display:
+                if trackers:
+                    newest = {owner: draw_tracks(frame, trackers[owner].tracks) for owner, frame in zip(owners, frames)}
+                else:
+                    newest = {owner: result.plot() for owner, result in zip(owners, results)}
+                for owner, image in newest.items():
+                    cv2.imshow("Object Detection" if len(specs) == 1 else f"Object Detection {specs[owner]}", image)
+
+                # Press 'q' to quit
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Release resources
+        for cap in sources:
+            if cap is not None:
+                cap.release()
+        if display:
+            cv2.destroyAllWindows()
+    print(meter.summary(settings), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()